@@ -0,0 +1,53 @@
+"""
+Helpers shared by the benchmark scripts.
+
+The scripts only use the public pystata API, so the same script can be run
+against two revisions of the tree (for example, from two git worktrees) to
+compare them. Each script initializes its own Stata; pass --edition to pick
+the edition.
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+
+def get_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--edition', default='mp',
+        help='Stata edition to initialize: mp, se, or be (default: mp)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of timed repetitions; the best one is reported (default: 3)')
+    return parser
+
+
+def init(args):
+    libdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib')
+    sys.path.insert(0, os.path.normpath(libdir))
+
+    from pystata import config
+    config.init(args.edition)
+    config.set_graph_show(False)
+
+
+def timeit(func, repeat=3, setup=None):
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def report(label, seconds, count=None, unit='op'):
+    line = '%-40s %10.4f s' % (label, seconds)
+    if count:
+        line += '   %10.3f us/%s' % (seconds / count * 1e6, unit)
+    print(line)
+    sys.stdout.flush()
@@ -0,0 +1,51 @@
+"""
+Time loading wide pandas DataFrames into Stata with pdataframe_to_data().
+
+The frames mix small integers, large integers, floats, and short strings,
+so that every column-type branch of the loader is exercised. Run the
+script on two revisions to compare them.
+"""
+from __future__ import print_function
+import _bench
+
+
+def make_frame(nobs, ncols, seed=12345):
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(ncols):
+        kind = i % 4
+        if kind == 0:
+            data['b%d' % i] = rng.integers(-100, 100, nobs)
+        elif kind == 1:
+            data['l%d' % i] = rng.integers(-2**30, 2**30, nobs)
+        elif kind == 2:
+            data['d%d' % i] = rng.standard_normal(nobs)
+        else:
+            data['s%d' % i] = rng.choice(['alpha', 'beta', 'gamma', 'delta'], nobs)
+
+    return pd.DataFrame(data)
+
+
+def main():
+    parser = _bench.get_parser(__doc__)
+    parser.add_argument('--obs', type=int, nargs='+', default=[1000, 10000],
+        help='numbers of observations (default: 1000 10000)')
+    parser.add_argument('--cols', type=int, nargs='+', default=[200, 2000],
+        help='numbers of columns (default: 200 2000)')
+    args = parser.parse_args()
+    _bench.init(args)
+
+    from pystata import stata
+
+    for ncols in args.cols:
+        for nobs in args.obs:
+            df = make_frame(nobs, ncols)
+            sec = _bench.timeit(lambda: stata.pdataframe_to_data(df, force=True), args.repeat)
+            _bench.report('pdataframe_to_data %dx%d' % (nobs, ncols), sec, ncols, 'column')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Compare running commands with run(quietly=True) and with run(discard=True).
+
+A trivial command, a summarize over 20 variables, and a multiple-line
+block run from a do-file are timed with each option.
+"""
+from __future__ import print_function
+import _bench
+
+_cmds = [
+    ('trivial', 'scalar pystata_bench = 1'),
+    ('summarize', 'summarize'),
+    ('block', 'scalar pystata_bench = 1\nsummarize\nscalar pystata_bench = 2')
+]
+
+
+def main():
+    parser = _bench.get_parser(__doc__)
+    parser.add_argument('--ncmds', type=int, default=2000,
+        help='number of commands per repetition (default: 2000)')
+    args = parser.parse_args()
+    _bench.init(args)
+
+    from pystata import stata
+
+    stata.run_many(['clear', 'set obs 1000', 'set seed 12345'] +
+        ['gen double x%d = rnormal()' % i for i in range(1, 21)], quietly=True, capture=False)
+
+    def run_loop(cmd, **kwargs):
+        for _ in range(args.ncmds):
+            stata.run(cmd, **kwargs)
+
+    for label, cmd in _cmds:
+        sec = _bench.timeit(lambda: run_loop(cmd, quietly=True), args.repeat)
+        _bench.report('run %s, quietly' % label, sec, args.ncmds, 'cmd')
+        sec = _bench.timeit(lambda: run_loop(cmd, discard=True), args.repeat)
+        _bench.report('run %s, discard' % label, sec, args.ncmds, 'cmd')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Time retrieving a large Stata matrix and a large Mata matrix as NumPy
+arrays.
+
+The block-filled paths used by get_return()/get_ereturn() and by the
+%%mata magic's matrix output are compared with converting the list of
+lists returned by sfi directly, which is what they did before.
+"""
+from __future__ import print_function
+import _bench
+
+
+def main():
+    parser = _bench.get_parser(__doc__)
+    parser.add_argument('--size', type=int, nargs='+', default=[1000, 5000],
+        help='numbers of rows and columns of the square matrices '
+             '(default: 1000 5000)')
+    args = parser.parse_args()
+    _bench.init(args)
+
+    import numpy as np
+    import sfi
+    from pystata import stata
+    from pystata.core import numpy2mata, numpy2stata
+
+    for n in args.size:
+        stata.run_many(['set seed 12345', 'mata: pystata_bench = runiform(%d, %d)' % (n, n),
+            'mata: st_matrix("pystata_bench", pystata_bench)'], quietly=True, capture=False)
+
+        label = 'Stata matrix %dx%d' % (n, n)
+        sec = _bench.timeit(lambda: np.array(sfi.Matrix.get('pystata_bench')), args.repeat)
+        _bench.report(label + ', list', sec, n * n, 'cell')
+        sec = _bench.timeit(lambda: numpy2stata.array_from_stata_matrix('pystata_bench'), args.repeat)
+        _bench.report(label + ', blocks', sec, n * n, 'cell')
+
+        label = 'Mata matrix %dx%d' % (n, n)
+        sec = _bench.timeit(lambda: np.array(sfi.Mata.get('pystata_bench')), args.repeat)
+        _bench.report(label + ', list', sec, n * n, 'cell')
+        sec = _bench.timeit(lambda: numpy2mata.array_from_mata('pystata_bench'), args.repeat)
+        _bench.report(label + ', blocks', sec, n * n, 'cell')
+
+    stata.run_many(['matrix drop pystata_bench', 'mata: mata drop pystata_bench'], quietly=True, capture=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Time the per-command overhead of stata.run() on trivial commands.
+
+Each command does almost no work in Stata, so the timing is dominated by
+output redirection, the streaming thread, and the final output flush.
+Run the script on two revisions to compare them.
+"""
+from __future__ import print_function
+import _bench
+
+
+def main():
+    parser = _bench.get_parser(__doc__)
+    parser.add_argument('--ncmds', type=int, default=10000,
+        help='number of commands per repetition (default: 10000)')
+    args = parser.parse_args()
+    _bench.init(args)
+
+    from pystata import config, stata
+
+    def run_loop(quietly):
+        for _ in range(args.ncmds):
+            stata.run('scalar pystata_bench = 1', quietly=quietly)
+
+    for streaming in [True, False]:
+        config.set_streaming_output_mode(streaming)
+        mode = 'streaming' if streaming else 'non-streaming'
+        sec = _bench.timeit(lambda: run_loop(False), args.repeat)
+        _bench.report('run %s' % mode, sec, args.ncmds, 'cmd')
+        sec = _bench.timeit(lambda: run_loop(True), args.repeat)
+        _bench.report('run %s, quietly' % mode, sec, args.ncmds, 'cmd')
+
+    config.set_streaming_output_mode(True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Time exporting numeric variables with nparray_from_data(), comparing the
+default list-based path with the typed path (typed=True).
+
+The dataset has ten variables of mixed storage types (byte, int, long,
+float, and double). Sizes are given as total numbers of cells.
+"""
+from __future__ import print_function
+import _bench
+
+_vars = [
+    ('byte', 'floor(runiform()*100)'),
+    ('int', 'floor(runiform()*30000)'),
+    ('long', 'floor(runiform()*2e9)'),
+    ('float', 'runiform()'),
+    ('double', 'rnormal()')
+]
+
+
+def make_data(stata, nobs, nvars=10):
+    cmds = ['clear', 'set seed 12345', 'set obs %d' % nobs]
+    for i in range(nvars):
+        sttype, expr = _vars[i % len(_vars)]
+        cmds.append('gen %s x%d = %s' % (sttype, i + 1, expr))
+
+    stata.run_many(cmds, quietly=True, capture=False)
+
+
+def main():
+    parser = _bench.get_parser(__doc__)
+    parser.add_argument('--cells', type=int, nargs='+', default=[1000000, 10000000],
+        help='numbers of cells to export; add 100000000 for the largest case '
+             '(default: 1000000 10000000)')
+    args = parser.parse_args()
+    _bench.init(args)
+
+    from pystata import stata
+
+    for cells in args.cells:
+        make_data(stata, cells // 10)
+        sec = _bench.timeit(lambda: stata.nparray_from_data(), args.repeat)
+        _bench.report('nparray_from_data %d cells' % cells, sec, cells, 'cell')
+        sec = _bench.timeit(lambda: stata.nparray_from_data(typed=True), args.repeat)
+        _bench.report('nparray_from_data typed %d cells' % cells, sec, cells, 'cell')
+
+
+if __name__ == '__main__':
+    main()
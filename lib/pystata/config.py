@@ -94,13 +94,18 @@ sfiinitialized = False
 stlibpath = None
 stipython = 0
 stoutputf = None
+stoutputf_atexit = False
+output_decoder = None
+stserial = 0
 
 stconfig = {
     "grwidth": ['default', 'in'],
     "grheight": ['default', 'in'],
     "grformat": 'svg',
     "grshow": True,
-    "streamout": 'on'
+    "streamout": 'on',
+    "dofile": 'temp',
+    "dofilecache": 256
 }
 
 pyversion = sys.version_info[0:3]
@@ -349,12 +354,42 @@ def status():
         print('      graphic format        ', stconfig['grformat'])
 
 
-def get_output():
+def _get_output_decoder():
+    global output_decoder
+    if output_decoder is None:
+        try:
+            output_decoder = codecs.getincrementaldecoder('utf-8')('backslashreplace')
+        except:
+            codecs.register_error('backslashreplace_py2', backslashreplace_py2)
+            output_decoder = codecs.getincrementaldecoder('utf-8')('backslashreplace_py2')
+
+    return output_decoder
+
+
+def next_serial():
+    global stserial
+    stserial += 1
+    return stserial
+
+
+def reset_output_decoder():
+    if output_decoder is not None:
+        output_decoder.reset()
+
+
+def get_output(final=False):
+    return decode_output(get_output_bytes(), final)
+
+
+def decode_output(data, final=False):
+    return _get_output_decoder().decode(data, final)
+
+
+def get_output_bytes():
     stlib.StataSO_GetOutputBuffer.restype = c_char_p
     foo = stlib.StataSO_GetOutputBuffer()
 
-    mystr = get_decode_str(c_char_p(foo).value)
-    return mystr
+    return c_char_p(foo).value or b''
 
 
 def get_stipython():
@@ -499,6 +534,10 @@ def _load_system_config():
                 else:
                     set_streaming_output_mode(flag='off')
 
+            dofile_pref = sfi.Preference.getSavedPref('pystata', 'dofile', '')
+            if dofile_pref!="":
+                set_dofile_mode(mode=dofile_pref)
+
             global stversion
             stversion = str(sfi.Scalar.getValue('c(stata_version)'))
 	    
@@ -661,12 +700,66 @@ def set_streaming_output_mode(flag, perm=False):
         _save_system_config("streamout", stconfig['streamout'])
 
 
-def set_output_file(filename, replace=False):
+def set_dofile_mode(mode, cachesize=None, perm=False):
+    """
+    Set how multiple-line commands are written to do-files before they are 
+    executed by :meth:`~pystata.stata.run`.
+
+    Parameters
+    ----------
+    mode : str
+        The do-file mode. It can be one of **temp**, **cache**, or 
+        **scratch**. With **temp**, a new temporary file is written for 
+        each block of commands. With **cache**, blocks are stored in files 
+        named after a hash of their content, so an identical block reuses 
+        the file that was already written; least recently used files are 
+        removed once the cache is full. With **scratch**, a single file is 
+        rewritten for each block. Default is **temp**. When commands are 
+        run from Python code that Stata is executing on behalf of an 
+        earlier :meth:`~pystata.stata.run` call, **scratch** uses a 
+        separate file for each level of nesting, and **cache** writes a 
+        temporary file instead, so the do-file being executed by the outer 
+        call is never overwritten or removed.
+
+    cachesize : int, optional
+        The maximum number of do-files kept with **cache**. Default is 256.
+
+    perm : bool, optional
+        When set to True, in addition to making the change right now, the 
+        `mode` setting will be remembered and become the default setting 
+        when you invoke Stata. Default is False.
+    """
+    global stconfig
+
+    if perm is not True and perm is not False:
+        raise ValueError("perm must be a boolean value") 
+
+    if mode not in ('temp', 'cache', 'scratch'):
+        raise ValueError("The do-file mode must be one of temp, cache, or scratch. Default is temp.")
+
+    if cachesize is not None:
+        if not isinstance(cachesize, int) or cachesize < 1:
+            raise ValueError("cachesize must be a positive integer")
+
+        stconfig['dofilecache'] = cachesize
+
+    stconfig['dofile'] = mode
+
+    if perm:
+        _save_system_config("dofile", stconfig['dofile'])
+
+
+def set_output_file(filename, replace=False, buffersize=None, maxbytes=None, 
+                    interval=None, backups=5, compress=None):
     """
     Write Stata output to a text file. By default, Stata output is printed on
     the screen. The file extension may be **.txt** or **.log**. You must 
     supply a file extension if you want one because none is assumed.
 
+    If any of `buffersize`, `maxbytes`, `interval`, or `compress` is 
+    specified, output is written through a buffered file sink that 
+    supports rotation and compression.
+
     Parameters
     ----------
     filename : str
@@ -674,6 +767,25 @@ def set_output_file(filename, replace=False):
 
     replace : bool, optional 
         Replace the output file if it exists. Default is False.
+
+    buffersize : int, optional
+        Number of bytes of output to buffer in memory before writing to the 
+        file. Default is 1 MB when a file sink is used.
+
+    maxbytes : int, optional
+        Rotate the file once this many bytes have been written to it. The 
+        current file is renamed to `filename`.1, earlier backups are 
+        renamed to `filename`.2, and so on.
+
+    interval : float, optional
+        Rotate the file once it has been open for this many seconds.
+
+    backups : int, optional
+        Number of rotated files to keep. Default is 5.
+
+    compress : str, optional
+        Compress the file as it is written. It can be **gzip** or **zstd**. 
+        The zstandard package is required for **zstd**.
     """
     global pyversion
     global stoutputf
@@ -684,12 +796,55 @@ def set_output_file(filename, replace=False):
 
         os.remove(filename)
 
+    if buffersize is not None or maxbytes is not None or interval is not None or compress is not None:
+        from pystata.core.stsink import FileSink
+        if buffersize is None:
+            buffersize = 1048576
+
+        set_output_sink(FileSink(filename, buffersize, maxbytes, interval, backups, compress))
+        return
+
     if pyversion[0] < 3:
         f = open(filename, 'ab')
     else:
         f = open(filename, 'a', newline='\n', encoding='utf-8')
 
-    stoutputf = f
+    set_output_sink(f)
+
+
+def set_output_sink(sink):
+    """
+    Send Stata output to a sink object instead of the screen. Any object 
+    with `write()` and `flush()` methods can be used, such as 
+    :class:`~pystata.core.stsink.RingBufferSink`, which keeps only the most 
+    recent output in memory. The sink is used by both the streaming and 
+    non-streaming output modes. A previous sink or output file is closed, 
+    and the current one is closed when the interpreter exits.
+
+    Parameters
+    ----------
+    sink : object
+        The object to write output to. Specify None to print output on the 
+        screen again.
+    """
+    global stoutputf
+    global stoutputf_atexit
+
+    if stoutputf is not None and stoutputf is not sink:
+        stoutputf.close()
+
+    stoutputf = sink
+    if sink is not None and not stoutputf_atexit:
+        atexit.register(close_output_file)
+        stoutputf_atexit = True
+
+
+def get_output_sink():
+    """
+    Return the object Stata output is currently written to, or None if 
+    output is printed on the screen.
+    """
+    return stoutputf
 
 
 def close_output_file():
@@ -702,4 +857,5 @@ def close_output_file():
     global stoutputf
     if stoutputf is not None:
         stoutputf.close()
+        stoutputf = None
 
@@ -1,53 +1,91 @@
 import sfi
 import numpy as np
+from pystata.core import numpy2stata
+
+_mata_npdtype = {
+    'real': np.float64,
+    'complex': np.complex128
+}
 
 def array_from_mata(mat):
-    return np.array(sfi.Mata.get(mat))
+    dtype = _mata_npdtype.get(sfi.Mata.getEltype(mat))
+    if dtype is None:
+        return np.array(sfi.Mata.get(mat))
+
+    nrows = sfi.Mata.getRowTotal(mat)
+    ncols = sfi.Mata.getColTotal(mat)
+    return numpy2stata.fill_matrix_blocks(lambda rows: sfi.Mata.get(mat, rows), nrows, ncols, dtype)
+
+
+_mata_eltype = {
+    'b': 'real',
+    'i': 'real',
+    'u': 'real',
+    'f': 'real',
+    'c': 'complex'
+}
+
+_mata_fill = {
+    'real': None,
+    'complex': 0j,
+    'string': ''
+}
+
+
+def _get_mata_shape(mat):
+    try:
+        return sfi.Mata.getRowTotal(mat), sfi.Mata.getColTotal(mat), sfi.Mata.getEltype(mat)
+    except Exception:
+        return None
 
 
-def array_to_mata(arr, mat):
+def array_to_mata(arr, mat, rows=None, cols=None):
     if not isinstance(arr, np.ndarray):
         raise TypeError("An NumPy array is required.")
 
-    ndim = len(arr.shape)
-    if ndim < 1 or ndim >= 3:
-        raise TypeError("Dimension of array must not be greater than 2.")
+    if arr.ndim == 0:
+        arr = arr.reshape(1, 1)
+    elif arr.ndim == 1:
+        arr = arr[np.newaxis, :]
+    elif arr.ndim > 2:
+        raise TypeError("Dimension of array must not be greater than 2; got an array of shape %s." % (arr.shape,))
 
-    nobs = len(arr)
-    if nobs == 0:
+    nrows, ncols = arr.shape
+    if nrows == 0 or ncols == 0:
         return None
 
-    dtype = arr.dtype.name
-    if dtype in ['bool_', 'bool8', 'byte']:
-        dtypestr = 'real'
-    elif dtype in ['short', 'intc', 'int8', 'int16', 'int32', 'ubyte', 'ushort', 'uintc', 'uint8', 'uint16']:
-        dtypestr = 'real'
-    elif dtype in ['int_', 'longlong', 'intp', 'int64', 'uint', 'ulonglong', 'uint32', 'uint64']:
-        dtypestr = 'real'
-    elif dtype in ['half', 'single', 'float16', 'float32']:
-        dtypestr = 'real'
-    elif dtype in ['double', 'float_', 'longfloat', 'float64', 'float96', 'float128']:
-        dtypestr = 'real'
-    elif dtype in ['csingle', 'cdouble', 'clongdouble', 'complex64', 'complex128', 'complex_']:
-        dtypestr = 'complex'
-    else:
-        dtypestr = 'string'
-
-    if ndim == 1:
-        if dtypestr=='real':
-            sfi.Mata.create(mat, 1, arr.shape[0], sfi.Missing.getValue())
-        elif dtypestr=='complex':
-            sfi.Mata.create(mat, 1, arr.shape[0], 0j)
-        else:
-            sfi.Mata.create(mat, 1, arr.shape[0], '')
-
-        sfi.Mata.store(mat, arr)
-    else:
-        if dtypestr=='real':
-            sfi.Mata.create(mat, arr.shape[0], arr.shape[1], sfi.Missing.getValue())
-        elif dtypestr=='complex':
-            sfi.Mata.create(mat, arr.shape[0], arr.shape[1], 0j)
-        else:
-            sfi.Mata.create(mat, arr.shape[0], arr.shape[1], '')
-
-        sfi.Mata.store(mat, arr)
+    eltype = _mata_eltype.get(arr.dtype.kind, 'string')
+    if eltype == 'real' and arr.dtype != np.float64:
+        arr = arr.astype(np.float64)
+    elif eltype == 'complex' and arr.dtype != np.complex128:
+        arr = arr.astype(np.complex128)
+
+    shape = _get_mata_shape(mat)
+    if rows is not None or cols is not None:
+        if shape is None:
+            raise ValueError("Mata matrix %s does not exist; it cannot be updated." % mat)
+        if shape[2] != eltype:
+            raise TypeError("Mata matrix %s is %s; it cannot be updated with %s values." % (mat, shape[2], eltype))
+
+        if rows is None:
+            rows = range(shape[0])
+        elif isinstance(rows, int):
+            rows = [rows]
+        if cols is None:
+            cols = range(shape[1])
+        elif isinstance(cols, int):
+            cols = [cols]
+
+        if len(rows) != nrows or len(cols) != ncols:
+            raise ValueError("Array of shape %s does not match the %d x %d submatrix." % ((nrows, ncols), len(rows), len(cols)))
+
+        sfi.Mata.store(mat, arr, list(rows), list(cols))
+        return None
+
+    if shape != (nrows, ncols, eltype):
+        fill = _mata_fill[eltype]
+        if fill is None:
+            fill = sfi.Missing.getValue()
+        sfi.Mata.create(mat, nrows, ncols, fill)
+
+    sfi.Mata.store(mat, arr)
@@ -1,5 +1,8 @@
 import sfi
 import numpy as np
+import fnmatch
+import numbers
+import re
 
 def _get_varname(arr):
     return [str(e) for e in arr]
@@ -7,34 +10,121 @@ def _get_varname(arr):
 
 def _add_var(name, type, stfr=None):
     if stfr is None:
-        if type=="byte":
-            sfi.Data.addVarByte(name)
-        elif type=="int":
-            sfi.Data.addVarInt(name)
-        elif type=="long":
-            sfi.Data.addVarLong(name)
-        elif type=="float":
-            sfi.Data.addVarFloat(name)
-        elif type=="double":
-            sfi.Data.addVarDouble(name)
-        else:
-            sfi.Data.addVarStr(name, 9)
+        stfr = sfi.Data
+
+    if type=="byte":
+        stfr.addVarByte(name)
+    elif type=="int":
+        stfr.addVarInt(name)
+    elif type=="long":
+        stfr.addVarLong(name)
+    elif type=="float":
+        stfr.addVarFloat(name)
+    elif type=="double":
+        stfr.addVarDouble(name)
+    elif type=="strL":
+        stfr.addVarStrL(name)
+    elif type[3:].isdigit():
+        stfr.addVarStr(name, int(type[3:]))
     else:
-        if type=="byte":
-            stfr.addVarByte(name)
-        elif type=="int":
-            stfr.addVarInt(name)
-        elif type=="long":
-            stfr.addVarLong(name)
-        elif type=="float":
-            stfr.addVarFloat(name)
-        elif type=="double":
-            stfr.addVarDouble(name)
-        else:
-            stfr.addVarStr(name, 9)
+        stfr.addVarStr(name, 9)
+
+
+def _get_str_type(nbytes):
+    if nbytes > _str_maxlen:
+        return 'strL'
+    else:
+        return 'str' + str(max(1, int(nbytes)))
+
+
+def _get_str_nbytes(arr):
+    if arr.dtype.kind not in ['U', 'S']:
+        arr = arr.astype(str)
+
+    if arr.size == 0:
+        return np.zeros(arr.shape[1:], dtype=np.int64)
+
+    if arr.dtype.kind == 'U':
+        arr = np.char.encode(arr, 'utf-8')
+
+    return np.char.str_len(arr).max(axis=0)
+
+
+def _get_column_buffer(arr, copy):
+    if arr.ndim == 1:
+        arr = arr[:, np.newaxis]
+
+    if not copy and not arr.flags.f_contiguous:
+        raise ValueError("Array is not Fortran-contiguous; it cannot be loaded without a copy.")
+
+    return arr
+
+
+def split_missing(values):
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    miss = values >= _missing_min
+    mask = np.zeros(values.shape, dtype=np.uint8)
+    mask[miss] = ((values[miss].view(np.uint64) - _missing_base) // _missing_step + 1).astype(np.uint8)
+    return np.where(miss, np.nan, values), mask
+
+
+def merge_missing(arr, mask):
+    arr = np.array(arr, dtype=np.float64, order='F')
+    mask = np.asarray(mask)
+    if mask.shape != arr.shape:
+        raise ValueError("The missing-value mask must have the same shape as the array.")
+
+    if mask.max() > 27:
+        raise ValueError("The missing-value mask contains an invalid missing-value code.")
 
+    miss = mask > 0
+    arr[miss] = ((mask[miss].astype(np.uint64) - np.uint64(1)) * _missing_step + _missing_base).view(np.float64)
+    return arr
 
-def array_to_stata(arr, stfr, prefix):
+
+def array_split_missing(arr):
+    if arr.dtype.names is not None:
+        mask = np.zeros((len(arr), len(arr.dtype.names)), dtype=np.uint8)
+        for i, name in enumerate(arr.dtype.names):
+            if arr.dtype[name] == np.float64:
+                arr[name], mask[:, i] = split_missing(arr[name])
+
+        return arr, mask
+
+    if arr.dtype.kind not in ['b', 'i', 'u', 'f']:
+        raise TypeError("A missing-value mask can only be created for numeric variables.")
+
+    return split_missing(arr)
+
+
+def check_array_layout(arr, copy, missingmask=None):
+    if not copy and missingmask is not None:
+        raise ValueError("Restoring missing values from a mask requires a copy of the array.")
+
+    if not copy and isinstance(arr, np.ndarray) and arr.dtype.names is not None:
+        raise ValueError("A structured array cannot be loaded without a copy.")
+
+    if not copy and isinstance(arr, np.ndarray) and arr.ndim in [1, 2]:
+        _get_column_buffer(arr, copy)
+
+
+def _get_array_type(dtype):
+    vtype = dtype.name
+    if vtype in ['bool_', 'bool8', 'bool', 'byte']:
+        return 'byte'
+    elif vtype in ['short', 'intc', 'int8', 'int16', 'int32', 'ubyte', 'ushort', 'uintc', 'uint8', 'uint16']:
+        return 'int'
+    elif vtype in ['int_', 'longlong', 'intp', 'int64', 'uint', 'ulonglong', 'uint32', 'uint64']:
+        return 'long'
+    elif vtype in ['half', 'single', 'float16', 'float32']:
+        return 'float'
+    elif vtype in ['double', 'float_', 'longfloat', 'float64', 'float96', 'float128']:
+        return 'double'
+    else:
+        return 'str'
+
+
+def prepare_array(arr, prefix, copy=True, missingmask=None):
     if not isinstance(arr, np.ndarray):
         raise TypeError("An NumPy array is required.")
 
@@ -46,44 +136,117 @@ def array_to_stata(arr, stfr, prefix):
     if nobs == 0:
         return None
 
-    vtype = arr.dtype.name
-    if vtype in ['bool_', 'bool8', 'byte']:
-        vtypestr = 'byte'
-    elif vtype in ['short', 'intc', 'int8', 'int16', 'int32', 'ubyte', 'ushort', 'uintc', 'uint8', 'uint16']:
-        vtypestr = 'int'
-    elif vtype in ['int_', 'longlong', 'intp', 'int64', 'uint', 'ulonglong', 'uint32', 'uint64']:
-        vtypestr = 'long'
-    elif vtype in ['half', 'single', 'float16', 'float32']:
-        vtypestr = 'float'
-    elif vtype in ['double', 'float_', 'longfloat', 'float64', 'float96', 'float128']:
+    if arr.dtype.names is not None:
+        return _prepare_structured(arr, prefix, copy, missingmask)
+
+    vtypestr = _get_array_type(arr.dtype)
+
+    if missingmask is not None:
+        if not copy:
+            raise ValueError("Restoring missing values from a mask requires a copy of the array.")
+
+        arr = merge_missing(arr, missingmask)
         vtypestr = 'double'
+
+    buf = _get_column_buffer(arr, copy)
+    ncol = buf.shape[1]
+    if vtypestr == 'str':
+        vtypes = [_get_str_type(nbytes) for nbytes in _get_str_nbytes(buf)]
     else:
-        vtypestr = 'str'
+        vtypes = [vtypestr] * ncol
+
+    return {
+        'cols': [buf[:, col] for col in range(ncol)],
+        'nobs': nobs,
+        'varnames': [prefix+str(col+1) for col in range(ncol)],
+        'vtypes': vtypes
+    }
+
+
+def _prepare_structured(arr, prefix, copy, missingmask):
+    if arr.ndim != 1:
+        raise TypeError("A structured array must be one-dimensional.")
+
+    if not copy:
+        raise ValueError("A structured array cannot be loaded without a copy.")
+
+    names = arr.dtype.names
+    cols = [arr[name] for name in names]
+    if missingmask is not None:
+        mask = np.asarray(missingmask)
+        if mask.shape != (len(arr), len(names)):
+            raise ValueError("The missing-value mask must have one column for each field of the array.")
+
+        for i in range(len(names)):
+            if mask[:, i].any():
+                cols[i] = merge_missing(cols[i], mask[:, i])
+
+    varnames = [name if sfi.SFIToolkit.isValidVariableName(name) else prefix+str(i+1) for i, name in enumerate(names)]
+    return prepare_columns(cols, varnames)
+
+
+def prepare_columns(cols, varnames):
+    if len(cols) != len(varnames):
+        raise ValueError("The number of columns and variable names must match.")
+
+    if len(cols) == 0:
+        return None
+
+    nobs = len(cols[0])
+    vtypes = []
+    for col in cols:
+        if not isinstance(col, np.ndarray) or col.ndim != 1:
+            raise TypeError("Each column must be a one-dimensional NumPy array.")
+        if len(col) != nobs:
+            raise ValueError("All columns must have the same length.")
+
+        vtypestr = _get_array_type(col.dtype)
+        if vtypestr == 'str':
+            vtypestr = _get_str_type(_get_str_nbytes(col))
+        vtypes.append(vtypestr)
+
+    if nobs == 0:
+        return None
+
+    return {
+        'cols': cols,
+        'nobs': nobs,
+        'varnames': list(varnames),
+        'vtypes': vtypes
+    }
+
+
+def store_array(plan, stfr):
+    if plan is None:
+        return None
+
+    cols = plan['cols']
+    varnames = plan['varnames']
+    vtypes = plan['vtypes']
+    ncol = len(varnames)
 
     if stfr is None:
-        sfi.Data.setObsTotal(nobs)
-        if ndim == 1:
-            _add_var(prefix+"1", vtypestr)
-            sfi.Data.store(0, None, arr)	
-        else:
-            ncol = arr.shape[1]
-            for col in range(ncol):
-                _add_var(prefix+str(col+1), vtypestr)
-                dta = arr[:,col]
-                sfi.Data.store(col, None, dta)
+        target = sfi.Data
     else:
-        fr = sfi.Frame.create(stfr)
-        fr.setObsTotal(nobs)
+        target = sfi.Frame.create(stfr)
 
-        if ndim == 1:
-            _add_var(prefix+"1", vtypestr, fr)
-            fr.store(0, None, arr)	
-        else:
-            ncol = arr.shape[1]
-            for col in range(ncol):
-                _add_var(prefix+str(col+1), vtypestr, fr)
-                dta = arr[:,col]
-                fr.store(col, None, dta)
+    target.setObsTotal(plan['nobs'])
+    start = 0
+    for col in range(1, ncol+1):
+        if col == ncol or vtypes[col] != vtypes[start]:
+            _add_var(varnames[start:col], vtypes[start], target)
+            start = col
+
+    for col in range(ncol):
+        target.store(col, None, np.ascontiguousarray(cols[col]))
+
+
+def array_to_stata(arr, stfr, prefix, copy=True, missingmask=None):
+    store_array(prepare_array(arr, prefix, copy, missingmask), stfr)
+
+
+def arrays_to_stata(cols, varnames, stfr):
+    store_array(prepare_columns(cols, varnames), stfr)
 
 
 def array_from_stata(stfr, var, obs, selectvar, valuelabel, missingval):
@@ -108,5 +271,265 @@ def array_from_stata(stfr, var, obs, selectvar, valuelabel, missingval):
             return(np.array(fr.get(var, obs, selectvar, valuelabel, missingval)))
 
 
+_numeric_types = ['byte', 'int', 'long', 'float', 'double']
+
+_str_maxlen = 2045
+
+_sttype_npdtype = {
+    'byte': np.int8,
+    'int': np.int16,
+    'long': np.int32,
+    'float': np.float32,
+    'double': np.float64
+}
+
+_typed_block_cells = 1000000
+
+_missing_min = 8.98846567431158e+307
+_missing_base = np.uint64(0x7fe0000000000000)
+_missing_step = np.uint64(0x0000010000000000)
+
+
+def _get_source(stfr):
+    if stfr is None:
+        return sfi.Data
+    else:
+        return sfi.Frame.connect(stfr)
+
+
+def _get_var_index(src, var):
+    if var is None:
+        return list(range(src.getVarCount()))
+
+    if isinstance(var, (int, np.integer)):
+        return [int(var)]
+
+    if isinstance(var, str):
+        return _expand_varlist(src, var)
+
+    varidx = []
+    for v in var:
+        if isinstance(v, (int, np.integer)):
+            varidx.append(int(v))
+        else:
+            varidx.extend(_expand_varlist(src, v))
+
+    return varidx
+
+
+def _expand_varlist(src, varlist):
+    names = None
+    varidx = []
+    for token in re.sub(r'\s*-\s*', '-', varlist).split():
+        if '-' in token:
+            first, last = token.split('-', 1)
+            start = src.getVarIndex(first)
+            stop = src.getVarIndex(last)
+            if stop < start:
+                raise ValueError("%s: variables out of order" % token)
+
+            varidx.extend(range(start, stop+1))
+        elif any(c in token for c in '*?~'):
+            if names is None:
+                names = [src.getVarName(v) for v in range(src.getVarCount())]
+
+            pattern = token.replace('~', '*')
+            matches = [v for v, name in enumerate(names) if fnmatch.fnmatchcase(name, pattern)]
+            if len(matches) == 0:
+                raise ValueError("variable %s not found" % token)
+            if '~' in token and len(matches) > 1:
+                raise ValueError("%s ambiguous abbreviation" % token)
+
+            varidx.extend(matches)
+        else:
+            varidx.append(src.getVarIndex(token))
+
+    return varidx
+
+
+def _get_obs_index(src, obs):
+    if obs is None:
+        return range(src.getObsTotal())
+
+    if isinstance(obs, (int, np.integer)):
+        return [int(obs)]
+
+    return list(obs)
+
+
+def _iter_obs_blocks(src, obs, chunksize):
+    if chunksize < 1:
+        raise ValueError("chunksize must be a positive integer.")
+
+    obs = _get_obs_index(src, obs)
+    for start in range(0, len(obs), chunksize):
+        yield obs[start:start+chunksize]
+
+
+def _column_to_array(values, sttype):
+    if sttype in _numeric_types:
+        try:
+            return np.array(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            pass
+
+    return np.array(values, dtype=object)
+
+
+def _get_vars(src, var):
+    varidx = _get_var_index(src, var)
+    names = [src.getVarName(v) for v in varidx]
+    sttypes = [src.getVarType(v) for v in varidx]
+    return varidx, names, sttypes
+
+
+def _fill_columns(src, varidx, names, dtypes, obs, selectvar, valuelabel, missingval):
+    cols = [np.empty(len(obs), dtype=dtype) for dtype in dtypes]
+    blocksize = max(1, _typed_block_cells // max(1, len(varidx)))
+    nrows = 0
+    for start in range(0, len(obs), blocksize):
+        block = obs[start:start+blocksize]
+        if missingval is None:
+            dta = src.getAsDict(varidx, block, selectvar, valuelabel)
+        else:
+            dta = src.getAsDict(varidx, block, selectvar, valuelabel, missingval)
+
+        nblock = 0
+        for i, name in enumerate(names):
+            values = dta[name]
+            cols[i][nrows:nrows+len(values)] = values
+            nblock = len(values)
+
+        nrows = nrows + nblock
+
+    return [col[:nrows] for col in cols]
+
+
+def _get_typed_columns(src, varidx, names, sttypes, obs, selectvar, valuelabel, missingval):
+    numeric = not valuelabel and (missingval is None or isinstance(missingval, numbers.Real))
+    dtypes = [np.float64 if numeric and sttype in _numeric_types else object for sttype in sttypes]
+    cols = _fill_columns(src, varidx, names, dtypes, obs, selectvar, valuelabel, missingval)
+
+    result = {}
+    for name, sttype, dtype, col in zip(names, sttypes, dtypes, cols):
+        if dtype == object:
+            col = _column_to_array(col, sttype)
+        result[name] = col
+
+    return result
+
+
+def array_from_stata_chunks(stfr, var, obs, selectvar, valuelabel, missingval, chunksize):
+    src = _get_source(stfr)
+    varidx, names, sttypes = _get_vars(src, var)
+    if len(varidx) == 0:
+        return
+
+    for block in _iter_obs_blocks(src, obs, chunksize):
+        cols = list(_get_typed_columns(src, varidx, names, sttypes, block, selectvar, valuelabel, missingval).values())
+        if len(cols[0]) == 0:
+            continue
+
+        if all(col.dtype == np.float64 for col in cols):
+            yield np.column_stack(cols)
+        else:
+            yield np.column_stack(cols).astype(str)
+
+
+def _get_typed_vars(src, var):
+    varidx, names, sttypes = _get_vars(src, var)
+    for name, sttype in zip(names, sttypes):
+        if sttype not in _numeric_types:
+            raise TypeError("Variable %s is not numeric; a typed export requires numeric variables." % name)
+
+    return varidx, names, sttypes
+
+
+def _fits_dtype(values, dtype):
+    if dtype == np.float64:
+        return True
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        return np.array_equal(values.astype(dtype).astype(np.float64), values, equal_nan=True)
+
+
+def _has_missing(stfr, name):
+    if stfr is None:
+        sfi.SFIToolkit.stata("capture assert !missing(%s)" % name)
+    else:
+        sfi.SFIToolkit.stata("capture frame %s: assert !missing(%s)" % (stfr, name))
+
+    return sfi.Scalar.getValue('c(rc)') != 0
+
+
+def _get_typed_dtypes(stfr, names, sttypes, missingval):
+    mval = None
+    if missingval is not None:
+        try:
+            mval = np.array([missingval], dtype=np.float64)
+        except (TypeError, ValueError):
+            pass
+
+    dtypes = []
+    for name, sttype in zip(names, sttypes):
+        dtype = _sttype_npdtype[sttype]
+        if dtype != np.float64 and (mval is None or not _fits_dtype(mval, dtype)):
+            if _has_missing(stfr, name):
+                dtype = np.float64
+
+        dtypes.append(dtype)
+
+    return dtypes
+
+
+def _fill_typed_columns(src, varidx, names, dtypes, obs, selectvar, missingval):
+    cols = _fill_columns(src, varidx, names, dtypes, obs, selectvar, False, missingval)
+    arr = np.empty(len(cols[0]) if cols else 0, dtype=[(name, col.dtype) for name, col in zip(names, cols)])
+    for name, col in zip(names, cols):
+        arr[name] = col
+
+    return arr
+
+
+def array_from_stata_typed(stfr, var, obs, selectvar, missingval):
+    src = _get_source(stfr)
+    if src.getObsTotal() <= 0:
+        return None
+
+    varidx, names, sttypes = _get_typed_vars(src, var)
+    dtypes = _get_typed_dtypes(stfr, names, sttypes, missingval)
+    obs = _get_obs_index(src, obs)
+    return _fill_typed_columns(src, varidx, names, dtypes, obs, selectvar, missingval)
+
+
+def array_from_stata_typed_chunks(stfr, var, obs, selectvar, missingval, chunksize):
+    src = _get_source(stfr)
+    varidx, names, sttypes = _get_typed_vars(src, var)
+    dtypes = _get_typed_dtypes(stfr, names, sttypes, missingval)
+    for block in _iter_obs_blocks(src, obs, chunksize):
+        arr = _fill_typed_columns(src, varidx, names, dtypes, block, selectvar, missingval)
+        if len(arr) > 0:
+            yield arr
+
+
 def array_from_matrix(stmat):
     return np.array(stmat)
+
+
+def fill_matrix_blocks(getter, nrows, ncols, dtype=np.float64):
+    arr = np.empty((nrows, ncols), dtype=dtype)
+    if nrows == 0 or ncols == 0:
+        return arr
+
+    blocksize = max(1, _typed_block_cells // ncols)
+    for start in range(0, nrows, blocksize):
+        end = min(start + blocksize, nrows)
+        arr[start:end] = getter(list(range(start, end)))
+
+    return arr
+
+
+def array_from_stata_matrix(name):
+    nrows = sfi.Matrix.getRowTotal(name)
+    ncols = sfi.Matrix.getColTotal(name)
+    return fill_matrix_blocks(lambda rows: sfi.Matrix.get(name, rows), nrows, ncols)
@@ -1,5 +1,10 @@
 import sfi
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
+import numbers
+from pystata import config
+from pystata.core import numpy2stata
 
 def _make_indexed_name(index, stnames, pdnames):
     count = 0
@@ -31,36 +36,317 @@ def _make_varname(s, index, stnames, pdnames):
         return varn
 
 
+_sttype_bounds = [
+    ('byte', -127, 100),
+    ('int', -32767, 32740),
+    ('long', -2147483647, 2147483620)
+]
+
+_sttype_rank = ['byte', 'int', 'long', 'float', 'double']
+
+_stata_epoch_ns = -315619200000000000
+_ns_per_ms = 1000000
+_ns_per_day = 86400000000000
+_timedelta_format = '%tcHH:MM:SS.sss'
+_dtype_char = 'pystata_dtype'
+
+
+def _get_target(stfr):
+    if stfr is None:
+        return sfi.Data
+    else:
+        return sfi.Frame.create(stfr)
+
+
 def _add_var(name, type, stfr=None):
     if stfr is None:
-        if type=="byte":
-            sfi.Data.addVarByte(name)
-        elif type=="int":
-            sfi.Data.addVarInt(name)
-        elif type=="long":
-            sfi.Data.addVarLong(name)
-        elif type=="float":
-            sfi.Data.addVarFloat(name)
-        elif type=="double":
-            sfi.Data.addVarDouble(name)
+        stfr = sfi.Data
+
+    if type=="byte":
+        stfr.addVarByte(name)
+    elif type=="int":
+        stfr.addVarInt(name)
+    elif type=="long":
+        stfr.addVarLong(name)
+    elif type=="float":
+        stfr.addVarFloat(name)
+    elif type=="double":
+        stfr.addVarDouble(name)
+    elif type=="strL":
+        stfr.addVarStrL(name)
+    elif type[3:].isdigit():
+        stfr.addVarStr(name, int(type[3:]))
+    else:
+        stfr.addVarStr(name, 9)
+
+
+def _is_categorical(dtype):
+    return isinstance(dtype, pd.CategoricalDtype)
+
+
+def _get_int_types(mins, maxs):
+    inttypes = np.full(len(mins), 'double', dtype=object)
+    for sttype, lower, upper in reversed(_sttype_bounds):
+        inttypes[(mins>=lower) & (maxs<=upper)] = sttype
+
+    return inttypes
+
+
+def _plan_columns(df):
+    dtypes = [dt if isinstance(dt, np.dtype) else np.dtype('O') for dt in df.dtypes]
+    kinds = np.array([dt.kind for dt in dtypes])
+    sizes = np.array([dt.itemsize for dt in dtypes])
+
+    sttypes = np.full(len(kinds), 'str', dtype=object)
+    sttypes[kinds=='b'] = 'byte'
+    sttypes[(kinds=='f') & (sizes<=4)] = 'float'
+    sttypes[(kinds=='f') & (sizes>4)] = 'double'
+
+    intcols = np.flatnonzero((kinds=='i') | (kinds=='u'))
+    if len(intcols) > 0:
+        ints = df.iloc[:, intcols]
+        mins = ints.min().to_numpy(dtype=np.float64)
+        maxs = ints.max().to_numpy(dtype=np.float64)
+        sttypes[intcols] = _get_int_types(mins, maxs)
+
+    catcols = [var for var, dt in enumerate(df.dtypes) if _is_categorical(dt)]
+    if len(catcols) > 0:
+        maxs = np.array([len(df.dtypes.iloc[var].categories)-1 for var in catcols], dtype=np.float64)
+        sttypes[catcols] = _get_int_types(np.zeros(len(catcols)), maxs)
+
+    return list(sttypes)
+
+
+def _plan_time_columns(df, sttypes, colvals, narrow=True):
+    timefmts = {}
+    for var, dt in enumerate(df.dtypes):
+        if isinstance(dt, pd.DatetimeTZDtype):
+            col = df.iloc[:, var].dt.tz_localize(None)
+        elif isinstance(dt, np.dtype) and dt.kind in ['M', 'm']:
+            col = df.iloc[:, var]
         else:
-            sfi.Data.addVarStr(name, 9)
+            continue
+
+        nat = col.isna().to_numpy()
+        if col.dtype.kind == 'm':
+            ticks = col.to_numpy(dtype='timedelta64[ns]').view(np.int64) // _ns_per_ms
+            timefmts[var] = _timedelta_format
+            sttypes[var] = 'double'
+        else:
+            ticks = col.to_numpy(dtype='datetime64[ns]').view(np.int64) - _stata_epoch_ns
+            if narrow and (ticks[~nat] % _ns_per_day == 0).all():
+                ticks = ticks // _ns_per_day
+                timefmts[var] = '%td'
+                sttypes[var] = 'long'
+            else:
+                ticks = ticks // _ns_per_ms
+                timefmts[var] = '%tc'
+                sttypes[var] = 'double'
+
+        values = ticks.astype(np.float64)
+        values[nat] = np.nan
+        colvals[var] = values
+
+    return timefmts
+
+
+def _set_time_formats(target, varnames, timefmts, stfr):
+    for var, fmt in timefmts.items():
+        target.setVarFormat(varnames[var], fmt)
+
+    timedeltas = [varnames[var] for var, fmt in timefmts.items() if fmt == _timedelta_format]
+    if len(timedeltas) > 0:
+        with _working_frame(stfr):
+            for name in timedeltas:
+                sfi.Characteristic.setVariableChar(name, _dtype_char, 'timedelta64')
+
+
+def _get_str_values(col):
+    vals = col.to_numpy(dtype=object)
+    return np.where(pd.isna(vals), '', vals).astype(str)
+
+
+def _plan_str_columns(df, sttypes, colvals):
+    for var, sttype in enumerate(sttypes):
+        if sttype == 'str':
+            colvals[var] = _get_str_values(df.iloc[:, var])
+            sttypes[var] = numpy2stata._get_str_type(numpy2stata._get_str_nbytes(colvals[var]))
+
+
+def _is_str_type(sttype):
+    return sttype.startswith('str')
+
+
+def _column_values(col):
+    if not _is_categorical(col.dtype):
+        return col
+
+    codes = col.cat.codes.to_numpy()
+    if (codes < 0).any():
+        return np.where(codes < 0, np.nan, codes)
+
+    return codes
+
+
+def _group_columns(sttypes):
+    groups = []
+    start = 0
+    for i in range(1, len(sttypes)+1):
+        if i==len(sttypes) or sttypes[i]!=sttypes[start]:
+            groups.append((sttypes[start], start, i))
+            start = i
+
+    return groups
+
+
+def _store_columns(target, df, sttypes, colvals, obs=None):
+    for sttype, start, stop in _group_columns(sttypes):
+        if _is_str_type(sttype):
+            for var in range(start, stop):
+                if var in colvals:
+                    target.store(var, obs, colvals[var])
+                else:
+                    target.store(var, obs, _get_str_values(df.iloc[:, var]))
+        elif stop-start==1 or any(var in colvals or _is_categorical(df.dtypes.iloc[var]) for var in range(start, stop)):
+            for var in range(start, stop):
+                if var in colvals:
+                    target.store(var, obs, colvals[var])
+                else:
+                    target.store(var, obs, _column_values(df.iloc[:, var]))
+        else:
+            target.store(list(range(start, stop)), obs, df.iloc[:, start:stop].to_numpy())
+
+
+@contextmanager
+def _working_frame(stfr):
+    if stfr is None:
+        yield
     else:
-        if type=="byte":
-            stfr.addVarByte(name)
-        elif type=="int":
-            stfr.addVarInt(name)
-        elif type=="long":
-            stfr.addVarLong(name)
-        elif type=="float":
-            stfr.addVarFloat(name)
-        elif type=="double":
-            stfr.addVarDouble(name)
+        cwf = sfi.Macro.getGlobal('c(frame)')
+        sfi.Frame.connect(stfr).changeToCWF()
+        try:
+            yield
+        finally:
+            sfi.Frame.connect(cwf).changeToCWF()
+
+
+def _add_value_labels(varnames, categories, start, stfr):
+    with _working_frame(stfr):
+        for var, cats in categories.items():
+            name = varnames[var]
+            if start == 0:
+                if name in sfi.ValueLabel.getNames():
+                    sfi.ValueLabel.removeLabel(name)
+
+                sfi.ValueLabel.createLabel(name)
+                sfi.ValueLabel.setVarValueLabel(name, name)
+
+            for code in range(start, len(cats)):
+                sfi.ValueLabel.setLabelValue(name, code, str(cats[code]))
+
+
+def _get_value_labels(names, stfr):
+    labels = {}
+    with _working_frame(stfr):
+        for name in names:
+            labname = sfi.ValueLabel.getVarValueLabel(name)
+            if labname != '':
+                labels[name] = sfi.ValueLabel.getValueLabels(labname)
+
+    return labels
+
+
+def _get_valid_values(values, missingval):
+    valid = values < numpy2stata._missing_min
+    if isinstance(missingval, numbers.Real):
+        valid &= values != missingval
+
+    return valid
+
+
+def _values_to_categorical(values, vlabels, missingval=None):
+    values = np.asarray(values, dtype=np.float64)
+    valid = _get_valid_values(values, missingval)
+    keys = np.array(sorted(vlabels), dtype=np.float64)
+    uniq = np.union1d(keys, values[valid])
+
+    labels = []
+    for v in uniq:
+        if v.is_integer() and int(v) in vlabels:
+            labels.append(vlabels[int(v)])
         else:
-            stfr.addVarStr(name, 9)
+            labels.append('%.16g' % v)
 
+    categories = pd.unique(pd.Series(labels, dtype=object))
+    catidx = pd.Index(categories).get_indexer(labels)
 
-def dataframe_to_stata(df, stfr):
+    codes = np.full(len(values), -1, dtype=np.int64)
+    codes[valid] = catidx[np.searchsorted(uniq, values[valid])]
+    return pd.Categorical.from_codes(codes, categories)
+
+
+def _get_time_formats(src, names, stfr):
+    timefmts = {}
+    for name in names:
+        fmt = src.getVarFormat(name)
+        if fmt[:3] in ['%tc', '%tC']:
+            timefmts[name] = '%tc'
+        elif fmt[:3] == '%td':
+            timefmts[name] = '%td'
+
+    if len(timefmts) > 0:
+        with _working_frame(stfr):
+            for name in list(timefmts):
+                if sfi.Characteristic.getVariableChar(name, _dtype_char) == 'timedelta64':
+                    timefmts[name] = _timedelta_format
+
+    return timefmts
+
+
+def _values_to_datetime(values, fmt, missingval=None):
+    values = np.asarray(values, dtype=np.float64)
+    valid = _get_valid_values(values, missingval)
+    if fmt == '%td':
+        ticks = np.round(values[valid]).astype(np.int64) * _ns_per_day
+    else:
+        ticks = np.round(values[valid]).astype(np.int64) * _ns_per_ms
+
+    ns = np.zeros(len(values), dtype=np.int64)
+    if fmt == _timedelta_format:
+        ns[valid] = ticks
+        out = ns.view('timedelta64[ns]')
+        out[~valid] = np.timedelta64('NaT')
+    else:
+        ns[valid] = ticks + _stata_epoch_ns
+        out = ns.view('datetime64[ns]')
+        out[~valid] = np.datetime64('NaT')
+
+    return out
+
+
+def _apply_time_formats(cols, timefmts, missingval=None):
+    for name, fmt in timefmts.items():
+        if name in cols and not isinstance(cols[name], pd.Categorical):
+            try:
+                cols[name] = _values_to_datetime(cols[name], fmt, missingval)
+            except (TypeError, ValueError):
+                pass
+
+    return cols
+
+
+def _apply_value_labels(cols, labels, missingval=None):
+    for name, vlabels in labels.items():
+        if name in cols:
+            try:
+                cols[name] = _values_to_categorical(cols[name], vlabels, missingval)
+            except (TypeError, ValueError):
+                pass
+
+    return cols
+
+
+def prepare_dataframe(df):
     if not isinstance(df, pd.DataFrame):
         raise TypeError("A Pandas dataframe is required.")
 
@@ -69,88 +355,212 @@ def dataframe_to_stata(df, stfr):
         return None
 
     colnames = list(df.columns)
+    sttypes = _plan_columns(df)
+    colvals = {}
+    timefmts = _plan_time_columns(df, sttypes, colvals)
+    _plan_str_columns(df, sttypes, colvals)
+    categories = dict((var, df.dtypes.iloc[var].categories) for var in range(len(colnames)) if _is_categorical(df.dtypes.iloc[var]))
+
+    return {
+        'df': df,
+        'nobs': nobs,
+        'sttypes': sttypes,
+        'colvals': colvals,
+        'timefmts': timefmts,
+        'categories': categories
+    }
+
+
+def store_dataframe(plan, stfr):
+    if plan is None:
+        return None
+
+    colnames = list(plan['df'].columns)
     stnames = []
+    varnames = [_make_varname(col, var+1, stnames, colnames) for var, col in enumerate(colnames)]
+    sttypes = plan['sttypes']
+
+    target = _get_target(stfr)
+    target.setObsTotal(plan['nobs'])
+    for sttype, start, stop in _group_columns(sttypes):
+        _add_var(varnames[start:stop], sttype, target)
+
+    _store_columns(target, plan['df'], sttypes, plan['colvals'])
+    _set_time_formats(target, varnames, plan['timefmts'], stfr)
+    if len(plan['categories']) > 0:
+        _add_value_labels(varnames, plan['categories'], 0, stfr)
+
+
+def dataframe_to_stata(df, stfr):
+    store_dataframe(prepare_dataframe(df), stfr)
 
-    if stfr is None:
-        sfi.Data.setObsTotal(nobs)
-        var = 0
-        for col in colnames:
-            vtype = df.dtypes[col].name
-            dta = df[col]
-            col = _make_varname(col, var+1, stnames, colnames)
-            if vtype=="int_" or vtype=="int8" or vtype=="int16" or vtype=="int32" or \
-                vtype=="uint8" or vtype=="uint16":
-                _add_var(col, "int")
-                sfi.Data.store(var, None, dta)
-            elif vtype=="int64" or vtype=='uint32':
-                _add_var(col, "long")
-                sfi.Data.store(var, None, dta)
-            elif vtype=="float_" or vtype=="float16" or vtype=="float32":
-                _add_var(col, "float")
-                sfi.Data.store(var, None, dta)
-            elif vtype=="float64":
-                _add_var(col, "double")
-                sfi.Data.store(var, None, dta)
-            elif vtype=="bool":
-                _add_var(col, "byte")
-                sfi.Data.store(var, None, dta)
-            else:
-                _add_var(col, "str")
-                sfi.Data.store(var, None, dta.astype(str))
 
-            var = var + 1
+def _promote_type(old, new, colname):
+    if old==new:
+        return old
+
+    if _is_str_type(old):
+        if not _is_str_type(new) or old=='strL':
+            return old
+        elif new=='strL' or int(new[3:]) > int(old[3:]):
+            return new
+        else:
+            return old
+
+    if _is_str_type(new):
+        raise TypeError("Column %s changed from a numeric to a string type." % colname)
+
+    if sorted([old, new])==['float', 'long']:
+        return 'double'
+
+    return max(old, new, key=_sttype_rank.index)
+
+
+def _recast_var(name, type, stfr):
+    config.next_serial()
+    if stfr is None:
+        sfi.SFIToolkit.stata("qui recast %s %s" % (type, name))
     else:
-        fr = sfi.Frame.create(stfr)
-        fr.setObsTotal(nobs)
-        var = 0
-        for col in colnames:
-            vtype = df.dtypes[col].name
-            dta = df[col]
-            col = _make_varname(col, var+1, stnames, colnames)
-            if vtype=="int_" or vtype=="int8" or vtype=="int16" or vtype=="int32" or \
-                vtype=="uint8" or vtype=="uint16":
-                _add_var(col, "int", fr)
-                fr.store(var, None, dta)
-            elif vtype=="int64" or vtype=='uint32':
-                _add_var(col, "long", fr)
-                fr.store(var, None, dta)
-            elif vtype=="float_" or vtype=="float16" or vtype=="float32":
-                _add_var(col, "float", fr)
-                fr.store(var, None, dta)
-            elif vtype=="float64":
-                _add_var(col, "double", fr)
-                fr.store(var, None, dta)
-            elif vtype=="bool":
-                _add_var(col, "byte", fr)
-                fr.store(var, None, dta)
-            else:
-                _add_var(col, "str", fr)
-                fr.store(var, None, dta.astype(str))
+        sfi.SFIToolkit.stata("qui frame %s: recast %s %s" % (stfr, type, name))
+
+
+def _recode_categories(df, categories, varnames, stfr):
+    if len(categories) == 0:
+        return df
+
+    df = df.copy(deep=False)
+    for var, cats in categories.items():
+        col = df.iloc[:, var]
+        if not _is_categorical(col.dtype):
+            continue
+
+        known = set(cats)
+        start = len(cats)
+        cats.extend(c for c in col.cat.categories if c not in known)
+        if len(cats) > start:
+            _add_value_labels(varnames, {var: cats}, start, stfr)
+
+        df.isetitem(var, pd.Categorical(col, categories=cats))
+
+    return df
+
+
+def dataframe_chunks_to_stata(chunks, stfr):
+    target = None
+    nobs = 0
+    for df in chunks:
+        if not isinstance(df, pd.DataFrame):
+            raise TypeError("A Pandas dataframe is required.")
 
-            var = var + 1
+        if len(df) == 0:
+            continue
+
+        if target is None:
+            colnames = list(df.columns)
+            stnames = []
+            varnames = [_make_varname(col, var+1, stnames, colnames) for var, col in enumerate(colnames)]
+            sttypes = _plan_columns(df)
+            colvals = {}
+            timefmts = _plan_time_columns(df, sttypes, colvals, False)
+            _plan_str_columns(df, sttypes, colvals)
+            categories = dict((var, list(df.dtypes.iloc[var].categories)) for var in range(len(colnames)) if _is_categorical(df.dtypes.iloc[var]))
+
+            target = _get_target(stfr)
+            target.setObsTotal(len(df))
+            for sttype, start, stop in _group_columns(sttypes):
+                _add_var(varnames[start:stop], sttype, target)
+
+            _set_time_formats(target, varnames, timefmts, stfr)
+            if len(categories) > 0:
+                _add_value_labels(varnames, categories, 0, stfr)
+        else:
+            if list(df.columns) != colnames:
+                raise ValueError("Each chunk must have the same columns as the first chunk.")
+
+            df = _recode_categories(df, categories, varnames, stfr)
+            chunk_types = _plan_columns(df)
+            colvals = {}
+            _plan_time_columns(df, chunk_types, colvals, False)
+            _plan_str_columns(df, chunk_types, colvals)
+            for var, chunk_type in enumerate(chunk_types):
+                sttype = _promote_type(sttypes[var], chunk_type, colnames[var])
+                if sttype != sttypes[var]:
+                    _recast_var(varnames[var], sttype, stfr)
+                    sttypes[var] = sttype
+
+            target.setObsTotal(nobs + len(df))
+
+        _store_columns(target, df, sttypes, colvals, range(nobs, nobs + len(df)))
+        nobs = nobs + len(df)
 
 
 def dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, missingval):
     if stfr is None:
-        nobs = sfi.Data.getObsTotal()
-        if nobs <= 0:
-            return None
+        src = sfi.Data
+    else:
+        src = sfi.Frame.connect(stfr)
 
-        if missingval is None:
-            df = pd.DataFrame(sfi.Data.getAsDict(var, obs, selectvar, valuelabel))
-        else:
-            df = pd.DataFrame(sfi.Data.getAsDict(var, obs, selectvar, valuelabel, missingval))
+    nobs = src.getObsTotal()
+    if nobs <= 0:
+        return None
 
-        return(df)
+    if missingval is None:
+        cols = src.getAsDict(var, obs, selectvar, False)
     else:
-        fr = sfi.Frame.connect(stfr)
-        nobs = fr.getObsTotal()
-        if nobs <= 0:
-            return None
+        cols = src.getAsDict(var, obs, selectvar, False, missingval)
+
+    if valuelabel:
+        _apply_value_labels(cols, _get_value_labels(list(cols.keys()), stfr), missingval)
+
+    _apply_time_formats(cols, _get_time_formats(src, list(cols.keys()), stfr), missingval)
+    return pd.DataFrame(cols)
+
+
+def dataframe_split_missing(df):
+    mask = {}
+    for col in df.columns:
+        kind = df[col].dtype.kind
+        if kind=='f':
+            values, mask[col] = numpy2stata.split_missing(df[col].to_numpy())
+            df[col] = values
+        elif kind in ['b', 'i', 'u']:
+            mask[col] = np.zeros(len(df), dtype=np.uint8)
+
+    return df, pd.DataFrame(mask, index=df.index)
+
+
+def dataframe_from_stata_chunks(stfr, var, obs, selectvar, valuelabel, missingval, chunksize):
+    src = numpy2stata._get_source(stfr)
+    varidx, names, sttypes = numpy2stata._get_vars(src, var)
+    if len(varidx) == 0:
+        return
+
+    labels = _get_value_labels(names, stfr) if valuelabel else None
+    timefmts = _get_time_formats(src, names, stfr)
+    nrows = 0
+    for block in numpy2stata._iter_obs_blocks(src, obs, chunksize):
+        cols = numpy2stata._get_typed_columns(src, varidx, names, sttypes, block, selectvar, False, missingval)
+        if valuelabel:
+            _apply_value_labels(cols, labels, missingval)
+
+        _apply_time_formats(cols, timefmts, missingval)
+
+        nblock = len(next(iter(cols.values())))
+        if nblock == 0:
+            continue
+
+        yield pd.DataFrame(cols, index=pd.RangeIndex(nrows, nrows + nblock))
+        nrows = nrows + nblock
+
+
+def _get_matrix_stripe(names, eqs):
+    if all(eq in ('', '_') for eq in eqs):
+        return names
+
+    return [eq + ':' + name for eq, name in zip(eqs, names)]
 
-        if missingval is None:
-            df = pd.DataFrame(fr.getAsDict(var, obs, selectvar, valuelabel))
-        else:
-            df = pd.DataFrame(fr.getAsDict(var, obs, selectvar, valuelabel, missingval))
 
-        return(df)
+def dataframe_from_matrix(name, arr):
+    index = _get_matrix_stripe(sfi.Matrix.getRowNames(name), sfi.Matrix.getRowEquations(name))
+    columns = _get_matrix_stripe(sfi.Matrix.getColNames(name), sfi.Matrix.getColEquations(name))
+    return pd.DataFrame(arr, index=index, columns=columns)
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+from pystata import config
+from collections import OrderedDict
+from contextlib import contextmanager
+import atexit
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import sfi
+
+_cache = OrderedDict()
+_cache_dir = None
+_scratch_files = {}
+_depth = 0
+
+
+@contextmanager
+def executing():
+    global _depth
+    _depth += 1
+    try:
+        yield
+    finally:
+        _depth -= 1
+
+
+def _write_file(filename, text):
+    with io.open(filename, 'w', encoding="utf-8") as f:
+        f.write(text)
+
+
+def _get_cache_dir():
+    global _cache_dir
+    if _cache_dir is None or not os.path.isdir(_cache_dir):
+        _cache_dir = tempfile.mkdtemp(prefix='pystata_do_')
+
+    return _cache_dir
+
+
+def _get_cached_file(text):
+    key = hashlib.sha1(config.get_encode_str(text)).hexdigest()
+    tmpf = _cache.get(key)
+    if tmpf is not None and os.path.isfile(tmpf):
+        _cache.move_to_end(key)
+        return tmpf
+
+    tmpf = os.path.join(_get_cache_dir(), key + '.do')
+    _write_file(tmpf, text)
+    _cache[key] = tmpf
+
+    while len(_cache) > config.stconfig['dofilecache']:
+        _, oldf = _cache.popitem(last=False)
+        try:
+            os.remove(oldf)
+        except OSError:
+            pass
+
+    return tmpf
+
+
+def _get_scratch_file(text):
+    tmpf = _scratch_files.get(_depth)
+    if tmpf is None or not os.path.isdir(os.path.dirname(tmpf)):
+        tmpf = os.path.join(_get_cache_dir(), 'scratch%d.do' % _depth)
+        _scratch_files[_depth] = tmpf
+
+    _write_file(tmpf, text)
+    return tmpf
+
+
+def get_dofile(text):
+    mode = config.stconfig['dofile']
+    if mode == 'cache' and _depth <= 1:
+        return _get_cached_file(text)
+    elif mode == 'scratch':
+        return _get_scratch_file(text)
+    else:
+        tmpf = sfi.SFIToolkit.getTempFile()
+        _write_file(tmpf, text)
+        return tmpf
+
+
+def clear_dofile_cache():
+    global _cache_dir
+    _cache.clear()
+    _scratch_files.clear()
+    if _cache_dir is not None:
+        shutil.rmtree(_cache_dir, ignore_errors=True)
+        _cache_dir = None
+
+
+atexit.register(clear_dofile_cache)
@@ -5,19 +5,27 @@ import sys
 import threading 
 import time
 
-def output_get_interactive_result(output, real_cmd, colon, mode):
-    try:
-        if mode==2:
-            if colon:
-                fmt_str1 = ". mata:\n"
-            else:
-                fmt_str1 = ". mata\n"
+def _get_interactive_markers(colon, mode):
+    if mode==2:
+        if colon:
+            fmt_str1 = ". mata:\n"
         else:
-            if colon:
-                fmt_str1 = ". python:\n"
-            else:
-                fmt_str1 = ". python\n"
-		
+            fmt_str1 = ". mata\n"
+        fmt_str2 = "-"*49 + " mata (type end to exit) "
+        fmt_str4 = ": end\n"
+    else:
+        if colon:
+            fmt_str1 = ". python:\n"
+        else:
+            fmt_str1 = ". python\n"
+        fmt_str2 = "-"*47 + " python (type end to exit) "
+        fmt_str4 = ">>> end\n"
+
+    return fmt_str1, fmt_str2, fmt_str4
+
+
+def _strip_interactive_prefix(output, real_cmd, fmt_str1, fmt_str2):
+    try:
         pos1 = output.index(fmt_str1)
         pos1 = pos1 + len(fmt_str1)
     except:
@@ -26,11 +34,6 @@ def output_get_interactive_result(output, real_cmd, colon, mode):
     output = output[pos1:]
 
     try:
-        if mode==2:
-            fmt_str2 = "-"*49 + " mata (type end to exit) "
-        else:
-            fmt_str2 = "-"*47 + " python (type end to exit) "
-
         pos2 = output.index(fmt_str2)
         pos2 = output.index("\n") + 1
     except:
@@ -48,39 +51,172 @@ def output_get_interactive_result(output, real_cmd, colon, mode):
     except:
         pos3 = 0
 
-    output = output[pos3:]
+    return output[pos3:]
 
-    try:
-        if mode==2:
-            fmt_str4 = ": end\n"
+
+class InteractiveOutputFilter:
+    """
+    Strip the echoed prefix and the end marker of an interactive Mata or 
+    Python session from its output. Output is fed in chunks as it arrives; 
+    the echoed prefix is stripped once enough text has been seen, and text 
+    is released up to the latest end marker, so the total cost is linear in 
+    the size of the output.
+    """
+    prefix_limit = 65536
+
+    def __init__(self, real_cmd, colon, mode):
+        self.real_cmd = real_cmd if real_cmd is not None else ''
+        self.fmt_str1, self.fmt_str2, self.fmt_str4 = _get_interactive_markers(colon, mode)
+        self.prefix = []
+        self.held = []
+        self.tail = ''
+
+    def _prefix_ready(self, output):
+        if len(output) >= self.prefix_limit:
+            return True
+
+        pos1 = output.find(self.fmt_str1)
+        if pos1 < 0:
+            return False
+
+        pos2 = output.find(self.fmt_str2, pos1)
+        if pos2 < 0:
+            return False
+
+        pos3 = output.find("\n", pos2)
+        if pos3 < 0:
+            return False
+
+        return len(output) - pos3 - 1 >= len(self.real_cmd)
+
+    def _feed_body(self, text):
+        if len(text)==0:
+            return ''
+
+        search = self.tail + text
+        pos = search.rfind(self.fmt_str4)
+        ntail = len(self.fmt_str4) - 1
+        self.tail = search[-ntail:] if ntail > 0 else ''
+        if pos < 0:
+            self.held.append(text)
+            return ''
+
+        pos = pos - (len(search) - len(text))
+        if pos >= 0:
+            output = ''.join(self.held) + text[:pos]
+            self.held = [text[pos:]]
         else:
-            fmt_str4 = ">>> end\n"
-        pos4 = output.rindex(fmt_str4)
-    except:
-        pos4 = 0
+            held = ''.join(self.held)
+            pos = len(held) + pos
+            output = held[:pos]
+            self.held = [held[pos:], text]
+
+        return output
+
+    def feed(self, text):
+        if self.prefix is not None:
+            self.prefix.append(text)
+            output = ''.join(self.prefix)
+            if not self._prefix_ready(output):
+                self.prefix = [output]
+                return ''
+
+            self.prefix = None
+            text = _strip_interactive_prefix(output, self.real_cmd, self.fmt_str1, self.fmt_str2)
+
+        return self._feed_body(text)
+
+    def finish(self, text=''):
+        if self.prefix is not None:
+            output = ''.join(self.prefix) + text
+            self.prefix = None
+            text = _strip_interactive_prefix(output, self.real_cmd, self.fmt_str1, self.fmt_str2)
+
+        return self._feed_body(text)
 
-    return output[:pos4]
+
+class CommandOutput:
+    """
+    Return code and captured output of one command run by 
+    stata.run_many(). The output is kept as raw bytes and only decoded 
+    when the output attribute is first accessed.
+    """
+    __slots__ = ('cmd', 'rc', 'raw', '_text')
+
+    def __init__(self, cmd, rc, raw):
+        self.cmd = cmd
+        self.rc = rc
+        self.raw = raw
+        self._text = None
+
+    @property
+    def output(self):
+        if self._text is None:
+            self._text = config.get_decode_str(self.raw)
+        return self._text
+
+    def __repr__(self):
+        return 'CommandOutput(cmd=%r, rc=%d, nbytes=%d)' % (self.cmd, self.rc, len(self.raw))
 
 
 class StataDisplay:
+    def __init__(self, notify=None):
+        self.notify = notify
+
     def write(self, text):
         textList = text.split("\n")
         for t in textList[:-1]:
             config.stlib.StataSO_AppendOutputBuffer(config.get_encode_str(t))
             config.stlib.StataSO_AppendOutputBuffer(config.get_encode_str("\n"))
         config.stlib.StataSO_AppendOutputBuffer(config.get_encode_str(textList[-1]))
+        if self.notify is not None:
+            self.notify()
+
+    def flush(self):
+        pass
+
+
+class NullOutput:
+    def write(self, text):
+        pass
 
     def flush(self):
         pass
 
 
 class StataError:
+    def __init__(self, notify=None):
+        self.notify = notify
+
     def write(self, text):
         config.stlib.StataSO_AppendOutputBuffer(config.get_encode_str(text))
+        if self.notify is not None:
+            self.notify()
 
     def flush(self):
         pass
 
+
+class ThreadOutput:
+    """route writes from the current thread to target, others to fallback"""
+
+    def __init__(self, target, fallback):
+        self.target = target
+        self.fallback = fallback
+        self.ident = threading.current_thread().ident
+
+    def write(self, text):
+        if threading.current_thread().ident == self.ident:
+            self.target.write(text)
+        else:
+            self.fallback.write(text)
+
+    def flush(self):
+        self.fallback.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
 	
 class RedirectOutput:
     """context manager for redirecting stdout/err"""
@@ -120,61 +256,132 @@ def _print_streaming_output(output, newline):
         sys.stdout.flush()
 
 
-class RepeatTimer(threading.Thread):
-    def __init__(self, tname, otype, queue, interval, real_cmd, colon, mode):       
+class StreamingOutputter(threading.Thread):
+    """
+    Output streaming thread driven by notifications instead of a fixed 
+    polling interval. The Stata output buffer is only read when Python code 
+    has written to it, when the poll interval expires, or when the command 
+    has finished, and never more often than every min_interval seconds. 
+    The poll interval starts at min_interval and doubles up to max_interval 
+    while reads of the buffer come back empty; it drops back to 
+    min_interval once a read returns data. Long-running commands that 
+    print little therefore cost only a few wakeups. Calling finish() wakes 
+    the thread immediately for the final flush.
+    """
+    def __init__(self, tname, otype, real_cmd, colon, mode, sink=None, 
+                 min_interval=0.015, max_interval=0.25, raise_error=True):
         threading.Thread.__init__(self, name=tname)
-        self.q = queue
         self.otype = otype
-        self.interval = interval
-        self.is_done = False
-        self.old_stdout = sys.stdout
-        self.old_stderr = sys.stderr
         self.real_cmd = real_cmd
         self.colon = colon
         self.mode = mode
+        if otype==2 and mode!=1:
+            self.filter = InteractiveOutputFilter(real_cmd, colon, mode)
+        else:
+            self.filter = None
+        self.sink = sink if sink is not None else _print_streaming_output
+        self.swap_output = sink is None
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.raise_error = raise_error
+        self.old_stdout = sys.stdout
+        self.old_stderr = sys.stderr
+        self.cond = threading.Condition()
+        self.pending = False
+        self.stopped = False
+        self.rc = None
+
+    def notify(self):
+        with self.cond:
+            self.pending = True
+            self.cond.notify()
+
+    def finish(self, rc):
+        with self.cond:
+            self.rc = rc
+            self.cond.notify()
 
     def done(self):
         sys.stdout = self.old_stdout
         sys.stderr = self.old_stderr
-        self.is_done = True
-
-    def run(self):       
-        while not self.is_done:
-            self.sys_stdout = sys.stdout
-            self.sys_stderr = sys.stderr
-            sys.stdout = self.old_stdout
-            sys.stderr = self.old_stderr
-            output = config.get_output()
-            if self.q.empty():
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def _emit(self, output, newline):
+        if not self.swap_output:
+            self.sink(output, newline)
+            return
+
+        sys_stdout = sys.stdout
+        sys_stderr = sys.stderr
+        sys.stdout = self.old_stdout
+        sys.stderr = self.old_stderr
+        try:
+            self.sink(output, newline)
+        finally:
+            sys.stdout = sys_stdout
+            sys.stderr = sys_stderr
+
+    def _fail(self, output):
+        if self.raise_error:
+            raise SystemError(output)
+
+        self._emit(output, False)
+
+    def _flush_final(self, rc, output):
+        if rc == 0:
+            if self.otype==1:
                 if len(output)!=0:
-                    if self.mode!=1 and self.otype==2:
-                        output = output_get_interactive_result(output, self.real_cmd, self.colon, self.mode)
-                    
-                    _print_streaming_output(output, False)
+                    self._emit(output, False)
             else:
-                rc = self.q.get()
-                self.done()
-                if rc == 0:
-                    if self.otype==1:
-                        if len(output)!=0:
-                            _print_streaming_output(output, False)    
-                    else:
-                        if self.mode!=1:
-                            output = output_get_interactive_result(output, self.real_cmd, self.colon, self.mode)
-                            _print_streaming_output(output, False)
-                        else:
-                            _print_streaming_output(output, True)
+                if self.mode!=1:
+                    output = self.filter.finish(output)
+                    self._emit(output, False)
                 else:
-                    if self.otype==1:
-                        raise SystemError(output)
+                    self._emit(output, True)
+        else:
+            if self.otype==1:
+                self._fail(output)
+            else:
+                if rc!=3000:
+                    if self.mode!=1:
+                        output = self.filter.finish(output)
+                        self._emit(output, False)
                     else:
-                        if rc!=3000:
-                            if self.mode!=1:
-                                output = output_get_interactive_result(output, self.real_cmd, self.colon, self.mode)
-                                _print_streaming_output(output, False)
-                            else:
-                                raise SystemError(output)
-
-            sys.stdout = self.sys_stdout
-            sys.stderr = self.sys_stderr
-            time.sleep(self.interval)
+                        self._fail(output)
+
+    def run(self):
+        interval = self.min_interval
+        lastread = time.time()
+        while True:
+            with self.cond:
+                while self.rc is None and not self.stopped:
+                    if self.pending:
+                        wait = lastread + self.min_interval - time.time()
+                    else:
+                        wait = lastread + interval - time.time()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                if self.stopped:
+                    break
+                self.pending = False
+                rc = self.rc
+
+            data = config.get_output_bytes()
+            lastread = time.time()
+            output = config.decode_output(data, rc is not None)
+            if rc is not None:
+                self._flush_final(rc, output)
+                break
+
+            if len(data)!=0:
+                interval = self.min_interval
+                if self.filter is not None:
+                    output = self.filter.feed(output)
+
+                if len(output)!=0:
+                    self._emit(output, False)
+            else:
+                interval = min(interval*2, self.max_interval)
@@ -0,0 +1,193 @@
+from __future__ import unicode_literals
+from collections import deque
+import gzip
+import io
+import os
+import time
+
+
+class _PlainWriter:
+    def __init__(self, filename):
+        self.f = io.open(filename, 'ab')
+
+    def write(self, data):
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class _GzipWriter:
+    def __init__(self, filename):
+        self.f = gzip.open(filename, 'ab')
+
+    def write(self, data):
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class _ZstdWriter:
+    def __init__(self, filename):
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemError('zstandard package is required for zstd compression.')
+
+        self.zstd = zstandard
+        self.raw = io.open(filename, 'ab')
+        self.f = zstandard.ZstdCompressor().stream_writer(self.raw)
+
+    def write(self, data):
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush(self.zstd.FLUSH_BLOCK)
+        self.raw.flush()
+
+    def close(self):
+        self.f.flush(self.zstd.FLUSH_FRAME)
+        self.raw.flush()
+        self.raw.close()
+
+
+_writers = {
+    None: _PlainWriter,
+    'gzip': _GzipWriter,
+    'zstd': _ZstdWriter
+}
+
+
+class FileSink:
+    """
+    Write Stata output to a file through an in-memory buffer.
+
+    Text is encoded as UTF-8 and written out once `buffersize` bytes have
+    accumulated, or on flush() once the oldest buffered text has waited at
+    least `flushinterval` seconds. When `maxbytes` or `interval` is set,
+    the file is rotated once it has received that many bytes or has been
+    open that many seconds, as checked on every write() and flush(): the
+    current file is renamed to filename.1, earlier backups are shifted up,
+    and at most `backups` of them are kept.
+    """
+    def __init__(self, filename, buffersize=1048576, maxbytes=None,
+                 interval=None, backups=5, compress=None, flushinterval=1.0):
+        if compress not in _writers:
+            raise ValueError("compress must be one of None, gzip, or zstd")
+
+        self.filename = filename
+        self.buffersize = buffersize
+        self.maxbytes = maxbytes
+        self.interval = interval
+        self.backups = backups
+        self.compress = compress
+        self.flushinterval = flushinterval
+        self.buf = []
+        self.nbuf = 0
+        self.buffered = None
+        self.closed = False
+        self._open()
+
+    def _open(self):
+        self.writer = _writers[self.compress](self.filename)
+        self.nbytes = 0
+        self.opened = time.time()
+
+    def _rotate(self):
+        self.writer.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.filename, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (self.filename, i + 1))
+
+        if self.backups > 0:
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+
+        self._open()
+
+    def _should_rotate(self):
+        if self.maxbytes is not None and self.nbytes + self.nbuf >= self.maxbytes:
+            return True
+        if self.interval is not None and time.time() - self.opened >= self.interval:
+            return True
+        return False
+
+    def _write_out(self):
+        if self.nbuf > 0:
+            self.writer.write(b''.join(self.buf))
+            self.nbytes += self.nbuf
+            self.buf = []
+            self.nbuf = 0
+
+        self.writer.flush()
+        self.buffered = None
+        if self._should_rotate():
+            self._rotate()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        if self.buffered is None:
+            self.buffered = time.time()
+
+        self.buf.append(data)
+        self.nbuf += len(data)
+        if self.nbuf >= self.buffersize or self._should_rotate():
+            self._write_out()
+
+    def flush(self):
+        if self.buffered is not None and time.time() - self.buffered >= self.flushinterval \
+                or self._should_rotate():
+            self._write_out()
+
+    def close(self):
+        if not self.closed:
+            self._write_out()
+            self.writer.close()
+            self.closed = True
+
+
+class RingBufferSink:
+    """
+    Keep only the most recent `maxbytes` bytes of Stata output in memory.
+    """
+    def __init__(self, maxbytes=1048576):
+        self.maxbytes = maxbytes
+        self.chunks = deque()
+        self.nbytes = 0
+        self.closed = False
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.chunks.append(data)
+        self.nbytes += len(data)
+        while self.nbytes > self.maxbytes:
+            first = self.chunks[0]
+            extra = self.nbytes - self.maxbytes
+            if len(first) <= extra:
+                self.chunks.popleft()
+                self.nbytes -= len(first)
+            else:
+                self.chunks[0] = first[extra:]
+                self.nbytes -= extra
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return b''.join(self.chunks).decode('utf-8', 'ignore')
+
+    def clear(self):
+        self.chunks.clear()
+        self.nbytes = 0
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,255 @@
+from __future__ import unicode_literals
+from pystata import config
+from pystata.core import stout
+from pystata.core import stdofile
+import functools
+import sys
+import threading
+import types
+
+if config.pyversion[0]<3:
+    from Queue import Queue
+    _iter_types = (types.GeneratorType,)
+else:
+    from queue import Queue
+    from concurrent.futures import Future, CancelledError
+    _iter_types = (types.GeneratorType, map)
+
+lock = threading.RLock()
+
+_jobs = Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def synchronized(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with lock, stdofile.executing():
+            config.next_serial()
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _locked_iter(it):
+    while True:
+        with lock:
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+def locked(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with lock:
+            res = func(*args, **kwargs)
+
+        if isinstance(res, _iter_types):
+            return _locked_iter(res)
+        return res
+
+    return wrapper
+
+
+class _OutputIterator(object):
+    def __init__(self, job):
+        self.job = job
+        self.pos = 0
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        res = loop.create_future()
+        self._poll(loop, res)
+        return res
+
+    def _poll(self, loop, res):
+        if res.cancelled():
+            return
+
+        wake = functools.partial(self._poll, loop, res)
+        ready, chunk = self.job._poll_chunk(self.pos, loop, wake)
+        if not ready:
+            return
+
+        if chunk is None:
+            res.set_exception(StopAsyncIteration())
+        else:
+            self.pos += 1
+            res.set_result(chunk)
+
+
+class StataJob(object):
+    def __init__(self, cmd, quietly=False, echo=False):
+        self.cmd = cmd
+        self.quietly = quietly
+        self.echo = echo
+        self.rc = None
+        self.future = Future()
+        self._chunks = []
+        self._closed = False
+        self._cancelled = False
+        self._cond = threading.Condition()
+        self._waiters = []
+
+    def _put_output(self, output, newline):
+        if newline:
+            output = output + '\n'
+        if len(output)==0:
+            return
+
+        with self._cond:
+            self._chunks.append(output)
+            self._cond.notify_all()
+            self._wake_waiters()
+
+    def _close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            self._wake_waiters()
+
+    def _wake_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for loop, wake in waiters:
+            try:
+                loop.call_soon_threadsafe(wake)
+            except RuntimeError:
+                pass
+
+    def _poll_chunk(self, pos, loop, wake):
+        with self._cond:
+            if pos < len(self._chunks):
+                return True, self._chunks[pos]
+            if self._closed:
+                return True, None
+
+            self._waiters.append((loop, wake))
+            return False, None
+
+    def _next_chunk(self, pos, timeout=None):
+        with self._cond:
+            while pos >= len(self._chunks) and not self._closed:
+                self._cond.wait(timeout)
+            if pos < len(self._chunks):
+                return self._chunks[pos]
+            return None
+
+    @property
+    def output(self):
+        with self._cond:
+            return ''.join(self._chunks)
+
+    def running(self):
+        return self.future.running()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def cancel(self):
+        if self.future.cancel():
+            self._close()
+            return True
+
+        if self.future.running():
+            self._cancelled = True
+            config.stlib.StataSO_SetBreak()
+            return True
+
+        return False
+
+    def iter_output(self):
+        pos = 0
+        chunk = self._next_chunk(pos)
+        while chunk is not None:
+            yield chunk
+            pos += 1
+            chunk = self._next_chunk(pos)
+
+    def __aiter__(self):
+        return _OutputIterator(self)
+
+    def __await__(self):
+        import asyncio
+        return asyncio.wrap_future(self.future).__await__()
+
+
+def _execute(job):
+    with lock, stdofile.executing():
+        cmds = job.cmd.splitlines()
+        if len(cmds) > 1:
+            scmd = "include " + stdofile.get_dofile(job.cmd)
+            echo = False
+        else:
+            scmd = job.cmd.strip()
+            echo = job.echo
+
+        if job.quietly:
+            scmd = "qui " + scmd
+
+        config.next_serial()
+        config.stlib.StataSO_ClearOutputBuffer()
+        config.reset_output_decoder()
+        outputter = stout.StreamingOutputter('Stata', 2, None, False, 1, sink=job._put_output, raise_error=False)
+        outputter.start()
+        rc = -1
+        try:
+            stdout = stout.ThreadOutput(stout.StataDisplay(outputter.notify), sys.stdout)
+            stderr = stout.ThreadOutput(stout.StataError(outputter.notify), sys.stderr)
+            with stout.RedirectOutput(stdout, stderr):
+                rc = config.stlib.StataSO_Execute(config.get_encode_str(scmd), echo)
+        finally:
+            outputter.finish(rc)
+            outputter.join()
+            outputter.done()
+
+    return rc
+
+
+def _work():
+    while True:
+        job = _jobs.get()
+        if not job.future.set_running_or_notify_cancel():
+            job._close()
+            continue
+
+        try:
+            job.rc = _execute(job)
+        except BaseException as e:
+            job._close()
+            job.future.set_exception(e)
+            continue
+
+        job._close()
+        if job.rc == 0:
+            job.future.set_result(job.output)
+        elif job._cancelled:
+            job.future.set_exception(CancelledError())
+        else:
+            job.future.set_exception(SystemError(job.output))
+
+
+def _ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='StataWorker')
+            _worker.daemon = True
+            _worker.start()
+
+
+def submit(cmd, quietly=False, echo=False):
+    job = StataJob(cmd, quietly, echo)
+    _jobs.put(job)
+    _ensure_worker()
+    return job
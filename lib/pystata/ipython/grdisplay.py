@@ -1,10 +1,106 @@
 from pystata.config import stlib, stconfig, get_encode_str
 from IPython.display import SVG, display, Image
 from pystata.ipython.ipy_utils import get_ipython_stata_cache_dir
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+import atexit
+import hashlib
 import sfi
 import os
+import shutil
 
 pdf_counter = 0
+_executor = None
+
+graph_cache_maxbytes = 67108864
+_graph_cache = OrderedDict()
+_graph_cache_nbytes = 0
+_graph_cache_dir = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=4)
+
+    return _executor
+
+
+def _done_future(obj):
+    fut = Future()
+    fut.set_result(obj)
+    return fut
+
+
+def _get_graph_cache_dir():
+    global _graph_cache_dir
+    if _graph_cache_dir is None:
+        _graph_cache_dir = os.path.join(get_ipython_stata_cache_dir(), 'graphs-' + str(os.getpid()))
+        atexit.register(shutil.rmtree, _graph_cache_dir, True)
+
+    if not os.path.isdir(_graph_cache_dir):
+        os.makedirs(_graph_cache_dir)
+
+    return _graph_cache_dir
+
+
+def _get_graph_key(gname, grformat, gwidth_str, gheight_str):
+    gph = os.path.join(_get_graph_cache_dir(), 'graph_key.gph')
+    rc = stlib.StataSO_Execute(get_encode_str('qui graph save %s "%s", replace' % (gname, gph)), False)
+    if rc!=0:
+        return None
+
+    fingerprint = hashlib.sha1()
+    with open(gph, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            fingerprint.update(block)
+
+    fingerprint.update(get_encode_str('\n'.join([grformat, gwidth_str, gheight_str])))
+    return fingerprint.hexdigest()
+
+
+def _get_cached_graph(key):
+    if key is None or key not in _graph_cache:
+        return None
+
+    graph_out = _graph_cache[key][0]
+    if not os.path.isfile(graph_out):
+        _remove_cached_graph(key)
+        return None
+
+    _graph_cache.move_to_end(key)
+    return graph_out
+
+
+def _remove_cached_graph(key):
+    global _graph_cache_nbytes
+    graph_out, size = _graph_cache.pop(key)
+    _graph_cache_nbytes -= size
+    try:
+        os.remove(graph_out)
+    except OSError:
+        pass
+
+
+def _add_cached_graph(key, graph_out, inuse):
+    global _graph_cache_nbytes
+    if key is None or not os.path.isfile(graph_out):
+        return
+
+    size = os.path.getsize(graph_out)
+    _graph_cache[key] = (graph_out, size)
+    _graph_cache_nbytes += size
+
+    for oldkey in list(_graph_cache):
+        if _graph_cache_nbytes <= graph_cache_maxbytes:
+            break
+        if oldkey not in inuse:
+            _remove_cached_graph(oldkey)
+
+
+def _display_ready(pending):
+    while pending and pending[0].done():
+        display(pending.pop(0).result())
 
 def _get_graphs_info():
     stlib.StataSO_Execute(get_encode_str("qui _gr_list list"), False)
@@ -113,17 +209,36 @@ def display_stata_graph():
             gheight = gwidth*384.0/528
 
     graphs_info = _get_graphs_info()
-    gdir = get_ipython_stata_cache_dir()
     glen = len(graphs_info)
     if glen > 0:
+        pending = []
+        inuse = set()
         for i in range(glen):
+            if grformat=='svg' or grformat=='png':
+                key = _get_graph_key(graphs_info[i], grformat, gwidth_str, gheight_str)
+                graph_out = _get_cached_graph(key)
+                if graph_out is not None:
+                    inuse.add(key)
+                    if grformat=='svg':
+                        pending.append(_get_executor().submit(SVG, filename=graph_out))
+                    else:
+                        pending.append(_get_executor().submit(Image, filename=graph_out))
+                    _display_ready(pending)
+                    continue
+
+                if key is None:
+                    graph_name = 'temp_graph' + str(i)
+                else:
+                    graph_name = key
+                    inuse.add(key)
+
             gph_disp = 'qui graph display %s' % graphs_info[i]
             rc = stlib.StataSO_Execute(get_encode_str(gph_disp), False)
             if rc!=0:
                 continue
 
             if grformat=='svg':
-                graph_out = os.path.join(gdir, 'temp_graph'+str(i)+'.svg')
+                graph_out = os.path.join(_get_graph_cache_dir(), graph_name+'.svg')
                 if gwidth_str!="" and gheight_str!="":
                     gph_exp = 'qui graph export "%s", name(%s) replace width(%s) height(%s) ' % (graph_out, graphs_info[i], gwidth_str, gheight_str)		
                 elif gwidth_str!="":
@@ -134,9 +249,10 @@ def display_stata_graph():
                     gph_exp = 'qui graph export "%s", name(%s) replace width(528) height(384)' % (graph_out, graphs_info[i])
 
                 stlib.StataSO_Execute(get_encode_str(gph_exp), False)
-                display(SVG(filename=graph_out))
+                _add_cached_graph(key, graph_out, inuse)
+                pending.append(_get_executor().submit(SVG, filename=graph_out))
             elif grformat=='png':
-                graph_out = os.path.join(gdir, 'temp_graph'+str(i)+'.png')
+                graph_out = os.path.join(_get_graph_cache_dir(), graph_name+'.png')
                 if gwidth_str!="" and gheight_str!="":
                     gph_exp = 'qui graph export "%s", name(%s) replace width(%s) height(%s) ' % (graph_out, graphs_info[i], gwidth_str, gheight_str)
                 elif gwidth_str!="":
@@ -147,7 +263,8 @@ def display_stata_graph():
                     gph_exp = 'qui graph export "%s", name(%s) replace ' % (graph_out, graphs_info[i])
 
                 stlib.StataSO_Execute(get_encode_str(gph_exp), False)
-                display(Image(filename=graph_out))
+                _add_cached_graph(key, graph_out, inuse)
+                pending.append(_get_executor().submit(Image, filename=graph_out))
             else:
                 graph_out = os.path.join(os.getcwd(), str(pdf_counter)+'.pdf')
                 if gwidth_str!="" and gheight_str!="":
@@ -160,5 +277,10 @@ def display_stata_graph():
                     gph_exp = 'qui graph export "%s", name(%s) replace ' % (graph_out, graphs_info[i])
 
                 stlib.StataSO_Execute(get_encode_str(gph_exp), False)
-                display(_Pdf_Display_Obj(os.path.relpath(graph_out), int(gwidth*1.1), int(gheight*1.1)))
+                pending.append(_done_future(_Pdf_Display_Obj(os.path.relpath(graph_out), int(gwidth*1.1), int(gheight*1.1))))
                 pdf_counter += 1
+
+            _display_ready(pending)
+
+        for fut in pending:
+            display(fut.result())
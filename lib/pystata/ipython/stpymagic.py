@@ -110,7 +110,7 @@ class PyStataMagic(Magics):
 
         Cell magic syntax:
 
-            %%stata [-d DATA] [-f DFLIST|ARRLIST] [-force]
+            %%stata [-d DATA] [-f DFLIST|ARRLIST] [-force] [-ftime]
              [-doutd DATAFRAME] [-douta ARRAY] [-foutd FRAMELIST] [-fouta FRAMELIST]
              [-ret DICTIONARY] [-eret DICTIONARY] [-sret DICTIONARY] [-qui] [-nogr]
              [-gw WIDTH] [-gh HEIGHT]
@@ -135,6 +135,10 @@ class PyStataMagic(Magics):
                                     into Stata as separate frames even if one or 
                                     more of the frames already exist in Stata.
 
+              -ftime                Print the time spent on preparing and on 
+                                    storing each array or dataframe loaded 
+                                    with -f.
+
               -doutd DATAFRAME      Save the dataset in memory as a pandas 
                                     dataframe when the cell completes.
 
@@ -182,7 +186,7 @@ class PyStataMagic(Magics):
             _stata.run(line)
             return
 
-        allowopts = ['-d:', '-f:', '-force', '-doutd:', '-douta:', '-foutd:', '-fouta:', '-ret:', '-eret:', '-sret:', '-qui', '-nogr', '-gw:', '-gh:']
+        allowopts = ['-d:', '-f:', '-force', '-ftime', '-doutd:', '-douta:', '-foutd:', '-fouta:', '-ret:', '-eret:', '-sret:', '-qui', '-nogr', '-gw:', '-gh:']
         args = _parse_arguments(line, allowopts, '%%stata?')
 
         if local_ns is None:
@@ -238,22 +242,23 @@ class PyStataMagic(Magics):
                 if input_ftype==0:
                     raise TypeError("%s is not a pandas dataframe or NumPy array. Only dataframe or array is allowed." % fr)
 
+            frvals = {}
             for fr in frames:
                 try:
-                    frval = local_ns[fr]
+                    frvals[fr] = local_ns[fr]
                 except KeyError:
-                    frval = self.shell.user_ns[fr]
+                    frvals[fr] = self.shell.user_ns[fr]
 
-                input_ftype = _get_input_type(frval)
-                try:
-                    if input_ftype==2:
-                        _stata.pdataframe_to_frame(frval, fr, force=force_to_load)
-                    else:
-                        _stata.nparray_to_frame(frval, fr, force=force_to_load)
-                except SystemError:
-                    raise
-                except:
-                    raise SystemError("Exception occurred. %s could not be loaded." % fr)
+            try:
+                frtimes = _stata.load_frames(frvals, force=force_to_load)
+            except SystemError:
+                raise
+            except:
+                raise SystemError("Exception occurred. %s could not be loaded." % ', '.join(frames))
+
+            if '-ftime' in args:
+                for fr in frames:
+                    print("%s: prepare %.3fs, store %.3fs" % (fr, frtimes[fr]['prepare'], frtimes[fr]['store']))
 
 
         if '-gw' in args or '-gh' in args:
@@ -0,0 +1,339 @@
+"""
+This module runs independent Stata jobs in a pool of worker processes.
+
+Each worker process initializes its own copy of Stata, so jobs such as
+replications of a simulation, bootstrap draws, or placebo runs can be
+executed in parallel.
+"""
+from __future__ import absolute_import, print_function
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import os
+import sys
+
+_seed_max = 2147483647
+_shm_align = 64
+_attached = {}
+
+
+def _init_worker(edition):
+    from pystata import config
+
+    sys_stdout = sys.stdout
+    with open(os.devnull, 'w') as f:
+        sys.stdout = f
+        try:
+            config.init(edition)
+        finally:
+            sys.stdout = sys_stdout
+
+    config.set_graph_show(False)
+
+
+def _attach_shm(name):
+    from multiprocessing import shared_memory
+
+    shm = _attached.get(name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+
+    return shm
+
+
+class SharedDataset(object):
+    """
+    A dataset whose columns are placed once in shared memory, so that it 
+    can be sent to many worker processes without being copied to each one.
+
+    Pickling a SharedDataset only transfers the name and layout of the 
+    shared memory block. Worker processes map the block and load the 
+    columns into Stata directly from it, so memory use stays close to one 
+    copy of the data plus the copy held by each worker's Stata.
+
+    The process that creates the dataset owns the shared memory; call 
+    :meth:`unlink` or use the dataset as a context manager to release it 
+    once all tasks using it have finished.
+
+    Parameters
+    ----------
+    data : DataFrame, NumPy array, or dict
+        The data to share. A two-dimensional array is split into columns 
+        named v1, v2, .... A dict maps variable names to one-dimensional 
+        arrays. Numeric, boolean, and string columns are supported; other 
+        pandas types, such as datetimes and categoricals, should be 
+        converted first.
+    """
+    def __init__(self, data):
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        if hasattr(data, 'columns'):
+            names = [str(c) for c in data.columns]
+            cols = [data[c].to_numpy() for c in data.columns]
+        elif isinstance(data, dict):
+            names = [str(c) for c in data]
+            cols = [np.asarray(data[c]) for c in data]
+        else:
+            data = np.asarray(data)
+            if data.ndim == 1:
+                data = data[:, np.newaxis]
+            if data.ndim != 2:
+                raise TypeError("Dimension of array must not be greater than 2.")
+            names = ['v'+str(i+1) for i in range(data.shape[1])]
+            cols = [data[:, i] for i in range(data.shape[1])]
+
+        layout = []
+        nbytes = 0
+        for i, col in enumerate(cols):
+            if col.dtype.kind == 'O':
+                col = np.array(['' if v is None or v != v else str(v) for v in col], dtype=str)
+            elif col.dtype.kind not in 'biufSU':
+                raise TypeError("Column %s has unsupported type %s." % (names[i], col.dtype))
+
+            cols[i] = col
+            offset = -(-nbytes // _shm_align) * _shm_align
+            layout.append((names[i], col.dtype.str, offset))
+            nbytes = offset + col.nbytes
+
+        self.nobs = len(cols[0]) if cols else 0
+        self.layout = layout
+        self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.name = self.shm.name
+        self.owner = True
+
+        for col, arr in zip(cols, self.columns()):
+            arr[:] = col
+
+    def __getstate__(self):
+        return {'name': self.name, 'nobs': self.nobs, 'layout': self.layout}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = _attach_shm(self.name)
+        self.owner = False
+
+    def columns(self):
+        """
+        Return the columns as NumPy arrays backed by the shared memory.
+        """
+        import numpy as np
+
+        return [np.ndarray((self.nobs,), dtype=np.dtype(dtype), buffer=self.shm.buf, offset=offset) 
+            for _, dtype, offset in self.layout]
+
+    def to_stata_data(self):
+        """
+        Load the dataset into the current Stata dataset, replacing it.
+        """
+        from pystata import stata
+        from pystata.core import numpy2stata, pandas2stata
+
+        colnames = [name for name, _, _ in self.layout]
+        stnames = []
+        varnames = [pandas2stata._make_varname(col, var+1, stnames, colnames) for var, col in enumerate(colnames)]
+
+        stata.run_many(['clear'], quietly=True, capture=False)
+        numpy2stata.arrays_to_stata(self.columns(), varnames, None)
+
+    def unlink(self):
+        """
+        Release the shared memory block. This should be called by the 
+        process that created the dataset.
+        """
+        if self.owner:
+            self.shm.close()
+            self.shm.unlink()
+            self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlink()
+
+
+def _load_data(data):
+    from pystata import stata
+
+    if isinstance(data, SharedDataset):
+        data.to_stata_data()
+    elif hasattr(data, 'columns'):
+        stata.pdataframe_to_data(data, force=True)
+    else:
+        stata.nparray_to_data(data, force=True)
+
+
+def _run_task(cmds, data, seed, quietly, returns, fetch):
+    from pystata import stata
+
+    if data is not None:
+        _load_data(data)
+
+    if seed is not None:
+        stata.run_many(['set seed %d' % seed], quietly=True, capture=False)
+
+    outs = stata.run_many(cmds, quietly=quietly, stop_on_error=True)
+    for out in outs:
+        if out.rc != 0:
+            raise SystemError(out.output)
+
+    res = {
+        'seed': seed,
+        'rc': [out.rc for out in outs],
+        'output': [out.output for out in outs]
+    }
+
+    if 'r' in returns:
+        res['r'] = stata.get_return()
+    if 'e' in returns:
+        res['e'] = stata.get_ereturn()
+    if 's' in returns:
+        res['s'] = stata.get_sreturn()
+
+    if fetch is True:
+        res['data'] = stata.pdataframe_from_data()
+    elif fetch:
+        res['data'] = stata.pdataframe_from_data(var=fetch)
+
+    return res
+
+
+def task_seed(seed, index):
+    """
+    Derive the Stata random-number seed used for a task.
+
+    Parameters
+    ----------
+    seed : int
+        The base seed of the pool.
+
+    index : int
+        The zero-based submission index of the task.
+
+    Returns
+    -------
+    int
+        A seed between 0 and 2,147,483,646 that depends only on `seed` and
+        `index`.
+    """
+    key = ('%d:%d' % (seed, index)).encode('utf-8')
+    return int(hashlib.sha256(key).hexdigest(), 16) % _seed_max
+
+
+class StataPool(object):
+    """
+    A pool of worker processes, each running its own Stata.
+
+    The workers are started with the **spawn** method, and each one calls
+    :meth:`~pystata.config.init` with the given edition. Tasks are dispatched
+    to whichever worker is free. When a base seed is given, every task
+    sets its own seed, derived with :func:`task_seed` from the base seed
+    and the order in which tasks were submitted, so results do not depend
+    on which worker runs a task.
+
+    Parameters
+    ----------
+    processes : int, optional
+        The number of worker processes. Default is the number of CPUs.
+
+    edition : str, optional
+        The Stata edition to be used. It can be one of **mp**, **se**, or
+        **be**. Default is **mp**. Note that each worker runs its own copy
+        of Stata; with Stata/MP, consider limiting the processors used by
+        each worker with **set processors**.
+
+    seed : int, optional
+        The base seed for per-task seeding. Default is None, which leaves
+        the seeds of the workers unchanged.
+    """
+    def __init__(self, processes=None, edition='mp', seed=None):
+        if seed is not None and not isinstance(seed, int):
+            raise TypeError('seed must be an integer')
+
+        self.seed = seed
+        self.ntasks = 0
+        self.executor = ProcessPoolExecutor(max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(edition,))
+
+    def submit(self, cmds, data=None, quietly=True, returns=('r', 'e'), fetch=None):
+        """
+        Submit a task to the pool.
+
+        Parameters
+        ----------
+        cmds : str or list of str
+            The Stata commands to run in the worker.
+
+        data : DataFrame, NumPy array, or SharedDataset, optional
+            The dataset to load into the worker before the commands run. A
+            DataFrame or array is pickled to the worker with every task; 
+            use a :class:`SharedDataset` to send a large dataset to all 
+            workers without copying it.
+
+        quietly : bool, optional
+            Suppress output from Stata commands. Default is True.
+
+        returns : tuple of str, optional
+            The results to collect after the commands run. It can contain
+            **r**, **e**, and **s**. Default is ('r', 'e').
+
+        fetch : True or list of str, optional
+            Return the dataset in the worker as a pandas DataFrame after the
+            commands run. Specify a list of variable names to return only
+            those variables. Default is None.
+
+        Returns
+        -------
+        Future
+            A future whose result is a dictionary with the keys **seed**,
+            **rc**, and **output**, plus **r**, **e**, **s**, and **data**
+            as requested. The future raises SystemError if any command fails.
+        """
+        if isinstance(cmds, str):
+            cmds = [cmds]
+        else:
+            cmds = list(cmds)
+
+        if self.seed is None:
+            seed = None
+        else:
+            seed = task_seed(self.seed, self.ntasks)
+        self.ntasks += 1
+
+        return self.executor.submit(_run_task, cmds, data, seed, quietly,
+            tuple(returns), fetch)
+
+    def map(self, tasks, data=None, quietly=True, returns=('r', 'e'), fetch=None):
+        """
+        Run a sequence of tasks and gather their results in order.
+
+        Parameters
+        ----------
+        tasks : iterable
+            Each element is the `cmds` argument of one task.
+
+        data, quietly, returns, fetch
+            Passed to :meth:`submit` for every task.
+
+        Returns
+        -------
+        list
+            The result dictionaries, in the order of `tasks`.
+        """
+        futures = [self.submit(cmds, data, quietly, returns, fetch) for cmds in tasks]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait=True):
+        """
+        Shut down the worker processes.
+        """
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
@@ -7,16 +7,21 @@ from ctypes import c_char_p, c_void_p, cast
 from pystata import config
 config.check_initialized()
 
-if config.pyversion[0]<3:
-	from Queue import LifoQueue
-	from codecs import open
+if config.pyversion[0]>=3:
+	from concurrent.futures import ThreadPoolExecutor
+	from collections.abc import Mapping
 else:
-	from queue import LifoQueue
+	from collections import Mapping
 
 import sfi
 from pystata.core import stout
+from pystata.core import stdofile
+from pystata.core import stworker
 import codeop
+import fnmatch
+import os
 import sys
+import time
 
 rc2 = 0
 gr_display_func = None
@@ -26,6 +31,7 @@ has_num_pand = {
 }
 
 try:
+	import numpy as np
 	from pystata.core import numpy2stata
 except:
 	has_num_pand['pknum'] = False
@@ -49,18 +55,21 @@ def _print_no_streaming_output(output, newline):
 			print(config.get_encode_str(output), end='', file=config.stoutputf)
 
 
+def _get_output_drained():
+	data = config.get_output_bytes()
+	return config.decode_output(data, len(data)==0)
+
+
 def _stata_wrk1(cmd, echo=False):
 	if config.stconfig['streamout']=='on':
 		try:
-			queue = LifoQueue()
-			outputter = stout.RepeatTimer('Stata', 1, queue, 0.015, None, None, None)
+			outputter = stout.StreamingOutputter('Stata', 1, None, None, None)
 			outputter.start()
 
-			with stout.RedirectOutput(stout.StataDisplay(), stout.StataError()):
+			with stout.RedirectOutput(stout.StataDisplay(outputter.notify), stout.StataError(outputter.notify)):
 				rc1 = config.stlib.StataSO_Execute(config.get_encode_str(cmd), echo)
 
-			queue.put(rc1)
-
+			outputter.finish(rc1)
 			outputter.join()
 			outputter.done()
 		except KeyboardInterrupt:
@@ -72,13 +81,13 @@ def _stata_wrk1(cmd, echo=False):
 			with stout.RedirectOutput(stout.StataDisplay(), stout.StataError()):
 				rc1 = config.stlib.StataSO_Execute(config.get_encode_str(cmd), echo)
 
-			output = config.get_output()
+			output = _get_output_drained()
 			while len(output)!=0:
 				if rc1 != 0:
 					raise SystemError(output)
 
 				_print_no_streaming_output(output, False)
-				output = config.get_output()
+				output = _get_output_drained()
 			else:
 				if rc1 != 0:
 					raise SystemError("failed to execute the specified command")
@@ -91,15 +100,13 @@ def _stata_wrk2(cmd, real_cmd, colon, mode):
 	global rc2
 	if config.stconfig['streamout']=='on':
 		try:
-			queue = LifoQueue()
-			outputter = stout.RepeatTimer('Stata', 2, queue, 0.015, real_cmd, colon, mode)
+			outputter = stout.StreamingOutputter('Stata', 2, real_cmd, colon, mode)
 			outputter.start()
 
-			with stout.RedirectOutput(stout.StataDisplay(), stout.StataError()):
+			with stout.RedirectOutput(stout.StataDisplay(outputter.notify), stout.StataError(outputter.notify)):
 				rc2 = config.stlib.StataSO_Execute(config.get_encode_str(cmd), False)
 
-			queue.put(rc2)
-
+			outputter.finish(rc2)
 			outputter.join()
 			outputter.done()
 		except KeyboardInterrupt:
@@ -111,28 +118,31 @@ def _stata_wrk2(cmd, real_cmd, colon, mode):
 			with stout.RedirectOutput(stout.StataDisplay(), stout.StataError()):
 				rc2 = config.stlib.StataSO_Execute(config.get_encode_str(cmd), False)
 
-			output = config.get_output()
+			output = _get_output_drained()
+			if mode!=1:
+				ofilter = stout.InteractiveOutputFilter(real_cmd, colon, mode)
+
 			if rc2 != 0:
 				if rc2 != 3000:
 					if mode!=1:
-						output = stout.output_get_interactive_result(output, real_cmd, colon, mode)
+						output = ofilter.finish(output)
 						_print_no_streaming_output(output, False)
 					else:
 						raise SystemError(config.get_encode_str(output))
 
 			else:
 				while len(output)!=0:
-					output_tmp = config.get_output()
+					output_tmp = _get_output_drained()
 					if len(output_tmp)==0:
 						if mode!=1:
-							output = stout.output_get_interactive_result(output, real_cmd, colon, mode)
+							output = ofilter.finish(output)
 							_print_no_streaming_output(output, False)
 						else:
 							_print_no_streaming_output(output, True)
 						break
 					else:
 						if mode!=1:
-							output = stout.output_get_interactive_result(output, real_cmd, colon, mode)
+							output = ofilter.feed(output)
 
 						_print_no_streaming_output(output, False)
 						output = output_tmp
@@ -141,6 +151,19 @@ def _stata_wrk2(cmd, real_cmd, colon, mode):
 			print('\nKeyboardInterrupt: --break--')
 
 
+def _stata_wrk_discard(cmd, echo=False):
+	try:
+		with stout.RedirectOutput(stout.NullOutput(), stout.NullOutput()):
+			rc = config.stlib.StataSO_Execute(config.get_encode_str(cmd), echo)
+
+		config.stlib.StataSO_ClearOutputBuffer()
+		if rc != 0:
+			raise SystemError("failed to execute the specified command; r(%d);" % rc)
+	except KeyboardInterrupt:
+		config.stlib.StataSO_SetBreak()
+		print('\nKeyboardInterrupt: --break--')
+
+
 def _get_user_input(uprompt):
 	if config.pyversion[0]==2:
 		return raw_input(uprompt)
@@ -148,7 +171,146 @@ def _get_user_input(uprompt):
 		return input(uprompt)
 
 
-def run(cmd, quietly=False, echo=False, inline=None):
+def _get_output_bytes():
+	output = config.get_output_bytes()
+	if len(output)==0:
+		return output
+
+	chunks = [output]
+	output = config.get_output_bytes()
+	while len(output)!=0:
+		chunks.append(output)
+		output = config.get_output_bytes()
+
+	return b''.join(chunks)
+
+
+class StataResult(stout.CommandOutput):
+	"""
+	The result of commands run by :meth:`run` with `result` set to True.
+
+	Attributes
+	----------
+	cmd : str
+		The commands that were executed.
+
+	rc : int
+		The return code. It is 0 if the commands succeeded.
+
+	wall : float
+		Elapsed wall-clock time in seconds.
+
+	cpu : float
+		CPU time of the process in seconds, including time spent in Stata.
+
+	nbytes : int
+		The size of the output in bytes.
+
+	raw : bytes
+		The output as UTF-8 encoded bytes.
+
+	output : str
+		The output text. It is decoded when first accessed.
+
+	r, e : dict
+		The **r()** and **e()** results, as returned by :meth:`get_return` 
+		and :meth:`get_ereturn`. They are retrieved from Stata when first 
+		accessed, which must happen before another command is run.
+
+	graphs : list of str
+		The names of the graphs in memory, as listed by **graph dir**. They
+		are retrieved from Stata when first accessed, which must happen 
+		before another command is run.
+	"""
+	__slots__ = ('wall', 'cpu', 'serial', '_r', '_e', '_graphs')
+
+	def __init__(self, cmd, rc, raw, wall, cpu, serial):
+		stout.CommandOutput.__init__(self, cmd, rc, raw)
+		self.wall = wall
+		self.cpu = cpu
+		self.serial = serial
+		self._r = None
+		self._e = None
+		self._graphs = None
+
+	@property
+	def nbytes(self):
+		return len(self.raw)
+
+	def _check_current(self, name):
+		if self.serial != config.stserial:
+			raise SystemError(name + ' is no longer available; another command has been run since.')
+
+	@property
+	def r(self):
+		if self._r is None:
+			self._check_current('r()')
+			self._r = get_return()
+		return self._r
+
+	@property
+	def e(self):
+		if self._e is None:
+			self._check_current('e()')
+			self._e = get_ereturn()
+		return self._e
+
+	@property
+	def graphs(self):
+		if self._graphs is None:
+			self._check_current('The graph list')
+			self._graphs = _get_graph_names()
+		return self._graphs
+
+	def __repr__(self):
+		return 'StataResult(rc=%d, wall=%.3f, cpu=%.3f, nbytes=%d)' % (self.rc, self.wall, self.cpu, self.nbytes)
+
+
+def _get_graph_names():
+	cmds = ["_return hold _pystata_r", "qui graph dir", 
+		"global _pystata_grlist `r(list)'", "_return restore _pystata_r"]
+	with stout.RedirectOutput(stout.NullOutput(), stout.NullOutput()):
+		for cmd in cmds:
+			config.stlib.StataSO_Execute(config.get_encode_str(cmd), False)
+
+	config.stlib.StataSO_ClearOutputBuffer()
+	grlist = sfi.Macro.getGlobal('_pystata_grlist').split()
+	sfi.Macro.setGlobal('_pystata_grlist', '')
+	return grlist
+
+
+def _check_interactive_cmd(scmd, opt):
+	if scmd in ["mata", "mata:", "python", "python:"]:
+		raise ValueError("%s cannot be used to start an interactive %s session" % (opt, scmd.rstrip(':')))
+
+
+def _run_result(cmd, quietly, echo):
+	cmds = cmd.splitlines()
+	if len(cmds) > 1:
+		scmd = "include " + stdofile.get_dofile(cmd)
+		echo = False
+	elif len(cmds) == 1:
+		scmd = cmds[0].strip()
+		_check_interactive_cmd(scmd, "result")
+	else:
+		scmd = ""
+
+	if quietly:
+		scmd = "qui " + scmd
+
+	wall = time.time()
+	cpu = time.process_time()
+	with stout.RedirectOutput(stout.StataDisplay(), stout.StataError()):
+		rc = config.stlib.StataSO_Execute(config.get_encode_str(scmd), echo)
+
+	output = _get_output_bytes()
+	wall = time.time() - wall
+	cpu = time.process_time() - cpu
+	return StataResult(cmd, rc, output, wall, cpu, config.stserial)
+
+
+@stworker.synchronized
+def run(cmd, quietly=False, echo=False, inline=None, discard=False, result=False):
 	"""
 	Run a single line or a block of Stata commands.
 
@@ -158,6 +320,8 @@ def run(cmd, quietly=False, echo=False, inline=None):
 	The set of commands will be placed in a temporary do-file and executed all
 	at once. Because the commands are executed from a do-file, you can add comments
 	and delimiters with the specified commands.
+	How the do-file is written is controlled by 
+	:meth:`~pystata.config.set_dofile_mode`.
 
 	Parameters
 	----------
@@ -178,6 +342,26 @@ def run(cmd, quietly=False, echo=False, inline=None):
 		None, the global setting specified with
 		:meth:`~pystata.config.set_graph_show` is applied.
 
+	discard : bool, optional
+		Run the commands quietly and discard their output without decoding
+		it. No output thread is started, and any output written by Python 
+		code is dropped. Graphs are not exported or displayed, regardless of 
+		`inline`. If a command fails, the SystemError raised reports only 
+		its return code. Default is False. This does not apply to 
+		interactive **mata** and **python** sessions.
+
+	result : bool, optional
+		Return a :class:`StataResult` instead of printing the output. 
+		Default is False. The output is captured as bytes and decoded only 
+		when requested, a failing command is reported through the return 
+		code of the result instead of an exception, and graphs are not 
+		displayed.
+
+	Returns
+	-------
+	StataResult or None
+		A StataResult if `result` is True; otherwise, None.
+
 	Raises
 	------
 	SystemError
@@ -194,9 +378,19 @@ def run(cmd, quietly=False, echo=False, inline=None):
 			raise TypeError('inline must be a boolean value')
 
 	config.stlib.StataSO_ClearOutputBuffer()
+	config.reset_output_decoder()
+	if result:
+		return _run_result(cmd, quietly, echo)
+
 	cmds = cmd.splitlines()
 	if len(cmds) == 0:
 		return
+	elif discard and (len(cmds) > 1 or cmds[0].strip() not in ("mata", "mata:", "python", "python:")):
+		if len(cmds) == 1:
+			_stata_wrk_discard("qui " + cmds[0], echo)
+		else:
+			_stata_wrk_discard("qui include " + stdofile.get_dofile(cmd))
+		return
 	elif len(cmds) == 1:
 		if inline:
 			config.stlib.StataSO_Execute(config.get_encode_str("qui _gr_list on"), False)
@@ -219,11 +413,7 @@ def run(cmd, quietly=False, echo=False, inline=None):
 				incmd = inprompt + incmd
 				incmds2 = incmds2 + incmd
 
-				tmpf = sfi.SFIToolkit.getTempFile()
-				with open(tmpf, 'w', encoding="utf-8") as f:
-					f.write(input_cmd+"\n")
-					f.write(incmds1)
-					f.write("end")
+				tmpf = stdofile.get_dofile(input_cmd + "\n" + incmds1 + "end")
 
 				if quietly:
 					_stata_wrk2("qui include " + tmpf, incmds2, has_colon, 2)
@@ -274,11 +464,7 @@ def run(cmd, quietly=False, echo=False, inline=None):
 					incmd = _get_user_input("... ")
 					inprompt = "... "
 				else:
-					tmpf = sfi.SFIToolkit.getTempFile()
-					with open(tmpf, 'w', encoding="utf-8") as f:
-						f.write(input_cmd+"\n")
-						f.write(incmds1)
-						f.write("end")
+					tmpf = stdofile.get_dofile(input_cmd + "\n" + incmds1 + "end")
 					
 					if quietly:
 						_stata_wrk2("qui include " + tmpf, incmds2, has_colon, 3)
@@ -303,9 +489,7 @@ def run(cmd, quietly=False, echo=False, inline=None):
 		if inline:
 			config.stlib.StataSO_Execute(config.get_encode_str("qui _gr_list on"), False)
 
-		tmpf = sfi.SFIToolkit.getTempFile()
-		with open(tmpf, 'w', encoding="utf-8") as f:
-			f.write(cmd)
+		tmpf = stdofile.get_dofile(cmd)
 
 		if quietly:
 			_stata_wrk2("qui include " + tmpf, None, False, 1)
@@ -324,7 +508,140 @@ def run(cmd, quietly=False, echo=False, inline=None):
 		config.stlib.StataSO_Execute(config.get_encode_str("qui _gr_list off"), False)
 
 
-def nparray_to_data(arr, prefix='v', force=False):
+@stworker.synchronized
+def run_many(cmds, quietly=False, echo=False, capture=True, stop_on_error=False):
+	"""
+	Run a sequence of Stata commands back to back.
+
+	This is intended for driver loops that execute many short commands, 
+	such as simulations. Output redirection is set up once for the whole 
+	sequence, and no streaming thread, graph handling, or output decoding 
+	takes place between commands. Errors do not raise an exception; the 
+	return code of each command is reported instead.
+
+	Parameters
+	----------
+	cmds : iterable of str
+		The commands to execute. This can be a list or a generator. An 
+		entry spanning multiple lines is run as a block of commands, as 
+		with :meth:`run`.
+
+	quietly : bool, optional
+		Suppress output from Stata commands. Default is False. When set to
+		True, each command is prefixed with **qui**.
+
+	echo : bool, optional
+		Echo each single-line command in its captured output. Default is 
+		False.
+
+	capture : bool, optional
+		Capture the output of each command. Default is True. When set to 
+		False, the output is discarded and only the return codes are kept.
+
+	stop_on_error : bool, optional
+		Stop at the first command that returns a nonzero return code. 
+		Default is False.
+
+	Returns
+	-------
+	list of CommandOutput
+		One entry per executed command, with attributes `cmd`, `rc`, 
+		`raw`, and `output`. The `raw` bytes are decoded into the `output` 
+		string only when it is first accessed.
+
+	Raises
+	------
+	ValueError
+		If an entry is a single-line **mata** or **python** command, which 
+		would start an interactive session. Commands before it have already 
+		been executed.
+	"""
+	config.check_initialized()
+
+	results = []
+	config.stlib.StataSO_ClearOutputBuffer()
+	if capture:
+		redirect = stout.RedirectOutput(stout.StataDisplay(), stout.StataError())
+	else:
+		redirect = stout.RedirectOutput(stout.NullOutput(), stout.NullOutput())
+
+	with redirect:
+		for cmd in cmds:
+			if len(cmd.splitlines()) > 1:
+				tmpf = stdofile.get_dofile(cmd)
+
+				scmd = "include " + tmpf
+				secho = False
+			else:
+				scmd = cmd.strip()
+				_check_interactive_cmd(scmd, "run_many")
+				secho = echo
+
+			if quietly:
+				scmd = "qui " + scmd
+
+			config.next_serial()
+			rc = config.stlib.StataSO_Execute(config.get_encode_str(scmd), secho)
+			if capture:
+				output = _get_output_bytes()
+			else:
+				output = b''
+				config.stlib.StataSO_ClearOutputBuffer()
+
+			results.append(stout.CommandOutput(cmd, rc, output))
+			if rc != 0 and stop_on_error:
+				break
+
+	return results
+
+
+def run_async(cmd, quietly=False, echo=False):
+	"""
+	Run a single line or a block of Stata commands without blocking the 
+	calling thread.
+
+	The commands are queued to a dedicated worker thread that owns all 
+	access to Stata, so jobs run one at a time in submission order. Calls 
+	from other threads to :meth:`run` and to the functions that access the 
+	data, frames, or stored results wait until the current job has 
+	finished; when such a function returns an iterator of chunks, each 
+	chunk waits in the same way. Output is captured in the returned handle 
+	rather than printed. This function requires Python 3.
+
+	Parameters
+	----------
+	cmd : str
+		The commands to execute. A multiple-line block is run from a 
+		do-file, as with :meth:`run`.
+
+	quietly : bool, optional
+		Suppress output from Stata commands. Default is False. When set to
+		True, output will be suppressed.
+
+	echo : bool, optional
+		Echo the command. Default is False. This only affects the output when
+		executing a single command.
+
+	Returns
+	-------
+	StataJob
+		A handle to the job. It can be awaited in a coroutine, or waited on 
+		with its `result()` method; both return the output of the commands 
+		and raise SystemError if the commands fail. `async for` over the 
+		handle, or iterating over `iter_output()`, yields the output in 
+		chunks as it is produced. `cancel()` removes a queued job, or sends 
+		a break to Stata for a running job, in which case the job raises 
+		CancelledError.
+	"""
+	config.check_initialized()
+	if config.pyversion[0]<3:
+		raise SystemError('run_async() requires Python 3.')
+
+	return stworker.submit(cmd, quietly, echo)
+
+
+@stworker.locked
+def nparray_to_data(arr, prefix='v', force=False, copy=True, missingmask=None):
 	"""
 	Load a NumPy array into Stata's memory, making it the current dataset.
 
@@ -344,7 +661,9 @@ def nparray_to_data(arr, prefix='v', force=False):
 	Parameters
 	----------
 	arr : NumPy array
-		The array to be loaded.
+		The array to be loaded. A one-dimensional structured array, such as 
+		one returned by a typed export, is loaded with one variable per 
+		field, named after the field when the name is a valid Stata name.
 
 	prefix : str, optional
 		The string to be used as the variable prefix. Default is **v**.
@@ -352,11 +671,33 @@ def nparray_to_data(arr, prefix='v', force=False):
 	force : bool, optional
 		Force loading of the array into Stata. Default is False.
 
+	copy : bool, optional
+		Allow the array to be copied into column-major order before it is
+		loaded. Default is True. A Fortran-contiguous array, or a contiguous
+		one-dimensional array, is loaded from its own buffer without a copy.
+		When set to False, an exception is raised for any other memory
+		layout instead of making the copy.
+
+	missingmask : NumPy array, optional
+		A uint8 array of the same shape as `arr` that records the Stata
+		missing value held by each cell, as returned by the export functions
+		with `missingmask` set to True. A code of 0 leaves the value in `arr`
+		unchanged, 1 stores the system missing value (.), and 2 to 27 store
+		the extended missing values .a to .z. When a mask is specified, the
+		variables are stored as doubles, and `copy` must be True. For a 
+		structured array, the mask has one column per field, and only the 
+		fields whose column contains missing-value codes are stored as 
+		doubles.
+
 	Raises
 	------
 	SystemError
 		This error can be raised if there is a dataset in memory that has
 		changed since it was last saved, and `force` is False.
+
+	ValueError
+		This error can be raised if `copy` is False and the array is not
+		stored in column-major order.
 	"""
 	global has_num_pand
 	config.check_initialized()
@@ -364,6 +705,8 @@ def nparray_to_data(arr, prefix='v', force=False):
 	if not has_num_pand['pknum']:
 		raise SystemError('NumPy package is required to use this function.')
 
+	numpy2stata.check_array_layout(arr, copy, missingmask)
+
 	changed = sfi.Scalar.getValue('c(changed)')
 	if int(changed)==1 and force is False:
 		raise SystemError('no; dataset in memory has changed since last saved')
@@ -371,17 +714,22 @@ def nparray_to_data(arr, prefix='v', force=False):
 	if int(changed)==0 or force is True:
 		run('clear')
 
-	numpy2stata.array_to_stata(arr, None, prefix)
+	numpy2stata.array_to_stata(arr, None, prefix, copy, missingmask)
 
 
+@stworker.locked
 def pdataframe_to_data(df, force=False):
 	"""
 	Load a pandas DataFrame into Stata's memory, making it the current dataset.
 
 	Each column of the DataFrame will be stored as a variable. If the column
 	type conforms to a Stata variable type, the variable type will be used in
-	Stata. Otherwise, the column will be converted into a string variable in
-	Stata.
+	Stata. A categorical column is stored as a numeric variable holding the
+	category codes, with a value label of the same name built from the
+	categories. A datetime column is stored as a Stata datetime (**%tc**), or
+	as a Stata date (**%td**) when every value falls on midnight, and a
+	timedelta column is stored as a number of milliseconds. Otherwise, the
+	column will be converted into a string variable in Stata.
 
 	The variable names will correspond to the column names of the DataFrame. If
 	the column name is a valid Stata name, it will be used as the variable
@@ -427,12 +775,71 @@ def pdataframe_to_data(df, force=False):
 	pandas2stata.dataframe_to_stata(df, None)
 
 
+@stworker.locked
+def pdataframe_chunks_to_data(chunks, force=False):
+	"""
+	Load a sequence of pandas DataFrames into Stata's memory as a single
+	dataset, making it the current dataset.
+
+	The DataFrames are loaded one at a time, so only the chunk being loaded
+	needs to be held in Python. This is useful for data that are read in
+	pieces, such as the iterator returned by **pandas.read_csv()** with the
+	`chunksize` argument. The variables and their names are set up from the
+	first chunk, as with :meth:`~pystata.stata.pdataframe_to_data`. Every
+	following chunk must have the same columns; its rows are appended to the
+	dataset as it arrives. If a later chunk holds values that do not fit in a
+	variable's storage type, the variable is promoted to a wider type.
+
+	If there is a dataset in memory and it has been changed since it was last
+	saved, an attempt to load the DataFrames into Stata will raise an
+	exception. The `force` argument will force loading of the DataFrames,
+	replacing the dataset in memory.
+
+	Parameters
+	----------
+	chunks : iterable of pandas DataFrames
+		The DataFrames to be loaded.
+
+	force : bool, optional
+		Force loading of the DataFrames into Stata. Default is False.
+
+	Raises
+	------
+	SystemError
+		This error can be raised if there is a dataset in memory that has been
+		changed since it was last saved, and `force` is False.
+
+	ValueError
+		This error can be raised if a chunk does not have the same columns as
+		the first chunk.
+
+	TypeError
+		This error can be raised if a column holding numeric values in the
+		first chunk holds strings in a later chunk.
+	"""
+	global has_num_pand
+	config.check_initialized()
+
+	if not has_num_pand['pkpand']:
+		raise SystemError('pandas package is required to use this function.')
+
+	changed = sfi.Scalar.getValue('c(changed)')
+	if int(changed)==1 and force is False:
+		raise SystemError('no; dataset in memory has changed since last saved')
+
+	if int(changed)==0 or force is True:
+		run('clear')
+
+	pandas2stata.dataframe_chunks_to_stata(chunks, None)
+
+
 class _DefaultMissing:
 	def __repr__(self):
 		return "_DefaultMissing()"
 
 
-def nparray_from_data(var=None, obs=None, selectvar=None, valuelabel=False, missingval=_DefaultMissing()):
+@stworker.locked
+def nparray_from_data(var=None, obs=None, selectvar=None, valuelabel=False, missingval=_DefaultMissing(), chunksize=None, typed=False, missingmask=False):
 	"""
 	Export values from the current Stata dataset into a NumPy array.
 
@@ -465,6 +872,37 @@ def nparray_from_data(var=None, obs=None, selectvar=None, valuelabel=False, miss
 		list are replaced by this value. If it is not specified, the numeric
 		value of the corresponding missing value in Stata is returned.
 
+	chunksize : int, optional
+		If `chunksize` is specified, an iterator is returned instead, which
+		yields one NumPy array for each block of `chunksize` observations. The
+		blocks are read from Stata as the iterator advances, so only one
+		block is held in Python at a time.
+
+	typed : bool, optional
+		Return a structured array with one typed field per variable. Default
+		is False. The fields are named after the variables, and their types
+		follow the storage types of the variables: **byte**, **int**,
+		**long**, **float**, and **double** become int8, int16, int32,
+		float32, and float64. A field is float64 instead when the variable 
+		contains missing values and `missingval` does not fit the narrower 
+		type. The types are decided once for the whole variable, so every 
+		chunk of a chunked export has the same fields. The values are 
+		filled into preallocated memory one column at a time. Only
+		numeric variables can be exported this way, and `valuelabel` cannot
+		be used.
+
+	missingmask : bool, optional
+		Return the missing values as NaN together with a mask that records
+		which missing value each cell held. Default is False. When set to
+		True, a tuple of the array and a uint8 array of the same shape is
+		returned; for a typed export, the mask has one column per field. A
+		mask code of 0 marks a nonmissing value, 1 marks the system missing
+		value (.), and 2 to 27 mark the extended missing values .a to .z.
+		The conversion is done on whole columns at once. Only numeric
+		variables can be exported this way, and `missingval` cannot be
+		specified. The mask can be passed back to
+		:meth:`~pystata.stata.nparray_to_data` to restore the missing values.
+
 	Returns
 	-------
 	NumPy array
@@ -472,6 +910,10 @@ def nparray_from_data(var=None, obs=None, selectvar=None, valuelabel=False, miss
 
 	Raises
 	------
+	TypeError
+		This error can be raised if `typed` is True and any of the variables
+		specified in `var` are string variables.
+
 	ValueError
 		This error can be raised for three possible reasons. One is if any of
 		the variable indices or names specified in `var` are out of
@@ -502,12 +944,34 @@ def nparray_from_data(var=None, obs=None, selectvar=None, valuelabel=False, miss
 		raise SystemError('NumPy package is required to use this function.')
 
 	if isinstance(missingval, _DefaultMissing):
-		return numpy2stata.array_from_stata(None, var, obs, selectvar, valuelabel, None)
+		missingval = None
+	elif missingmask:
+		raise ValueError('missingval cannot be used with missingmask')
+
+	if typed:
+		if valuelabel:
+			raise ValueError('valuelabel cannot be used with a typed export')
+
+		if chunksize is not None:
+			arr = numpy2stata.array_from_stata_typed_chunks(None, var, obs, selectvar, missingval, chunksize)
+		else:
+			arr = numpy2stata.array_from_stata_typed(None, var, obs, selectvar, missingval)
+	elif chunksize is not None:
+		arr = numpy2stata.array_from_stata_chunks(None, var, obs, selectvar, valuelabel, missingval, chunksize)
 	else:
-		return numpy2stata.array_from_stata(None, var, obs, selectvar, valuelabel, missingval)
+		arr = numpy2stata.array_from_stata(None, var, obs, selectvar, valuelabel, missingval)
+
+	if missingmask and arr is not None:
+		if chunksize is not None:
+			return map(numpy2stata.array_split_missing, arr)
+		else:
+			return numpy2stata.array_split_missing(arr)
+
+	return arr
 
 
-def pdataframe_from_data(var=None, obs=None, selectvar=None, valuelabel=False, missingval=_DefaultMissing()):
+@stworker.locked
+def pdataframe_from_data(var=None, obs=None, selectvar=None, valuelabel=False, missingval=_DefaultMissing(), chunksize=None, missingmask=False):
 	"""
 	Export values from the current Stata dataset into a pandas DataFrame.
 
@@ -533,17 +997,37 @@ def pdataframe_from_data(var=None, obs=None, selectvar=None, valuelabel=False, m
 		values for the variables specified in `var` are to be excluded.
 
 	valuelabel : bool, optional
-		Use the value label when available. Default is False.
+		Use the value label when available. Default is False. When set to
+		True, each variable with a value label is returned as a categorical
+		column. It is built from the numeric values and the value label,
+		without creating a string for each observation.
 
 	missingval : :ref:`_DefaultMissing <ref-defaultmissing>`, `optional`
 		If `missingval` is specified, all the missing values in the returned
 		list are replaced by this value. If it is not specified, the numeric
 		value of the corresponding missing value in Stata is returned.
 
+	chunksize : int, optional
+		If `chunksize` is specified, an iterator is returned instead, which
+		yields one pandas DataFrame for each block of `chunksize`
+		observations. The blocks are read from Stata as the iterator
+		advances, so only one block is held in Python at a time.
+
+	missingmask : bool, optional
+		Return the missing values as NaN together with a mask that records
+		which missing value each cell held. Default is False. When set to
+		True, a tuple of the DataFrame and a DataFrame of uint8 codes for its
+		numeric columns is returned. A code of 0 marks a nonmissing value, 1
+		marks the system missing value (.), and 2 to 27 mark the extended
+		missing values .a to .z. The conversion is done on whole columns at
+		once, and `missingval` cannot be specified.
+
 	Returns
 	-------
 	pandas DataFrame
 		A pandas DataFrame containing the values from the dataset in memory.
+		Variables with a **%tc** or **%td** display format are returned as
+		datetime columns.
 
 	Raises
 	------
@@ -562,12 +1046,26 @@ def pdataframe_from_data(var=None, obs=None, selectvar=None, valuelabel=False, m
 		raise SystemError('pandas package is required to use this function.')
 
 	if isinstance(missingval, _DefaultMissing):
-		return pandas2stata.dataframe_from_stata(None, var, obs, selectvar, valuelabel, None)
+		missingval = None
+	elif missingmask:
+		raise ValueError('missingval cannot be used with missingmask')
+
+	if chunksize is not None:
+		df = pandas2stata.dataframe_from_stata_chunks(None, var, obs, selectvar, valuelabel, missingval, chunksize)
 	else:
-		return pandas2stata.dataframe_from_stata(None, var, obs, selectvar, valuelabel, missingval)
+		df = pandas2stata.dataframe_from_stata(None, var, obs, selectvar, valuelabel, missingval)
+
+	if missingmask and df is not None:
+		if chunksize is not None:
+			return map(pandas2stata.dataframe_split_missing, df)
+		else:
+			return pandas2stata.dataframe_split_missing(df)
 
+	return df
 
-def nparray_to_frame(arr, stfr, prefix='v', force=False):
+
+@stworker.locked
+def nparray_to_frame(arr, stfr, prefix='v', force=False, copy=True, missingmask=None):
 	"""
 	Load a NumPy array into a specified frame in Stata.
 
@@ -586,7 +1084,9 @@ def nparray_to_frame(arr, stfr, prefix='v', force=False):
 	Parameters
 	----------
 	arr : NumPy array
-		The array to be loaded.
+		The array to be loaded. A one-dimensional structured array, such as 
+		one returned by a typed export, is loaded with one variable per 
+		field, named after the field when the name is a valid Stata name.
 
 	stfr : str
 		The frame in which to store the array.
@@ -598,11 +1098,33 @@ def nparray_to_frame(arr, stfr, prefix='v', force=False):
 		Force loading of the array into the frame if the frame already exists.
 		Default is False.
 
+	copy : bool, optional
+		Allow the array to be copied into column-major order before it is
+		loaded. Default is True. A Fortran-contiguous array, or a contiguous
+		one-dimensional array, is loaded from its own buffer without a copy.
+		When set to False, an exception is raised for any other memory
+		layout instead of making the copy.
+
+	missingmask : NumPy array, optional
+		A uint8 array of the same shape as `arr` that records the Stata
+		missing value held by each cell, as returned by the export functions
+		with `missingmask` set to True. A code of 0 leaves the value in `arr`
+		unchanged, 1 stores the system missing value (.), and 2 to 27 store
+		the extended missing values .a to .z. When a mask is specified, the
+		variables are stored as doubles, and `copy` must be True. For a 
+		structured array, the mask has one column per field, and only the 
+		fields whose column contains missing-value codes are stored as 
+		doubles.
+
 	Raises
 	------
 	SystemError
 		This error can be raised if the specified frame already exists in
 		Stata, and `force` is False.
+
+	ValueError
+		This error can be raised if `copy` is False and the array is not
+		stored in column-major order.
 	"""
 	global has_num_pand
 	config.check_initialized()
@@ -610,6 +1132,8 @@ def nparray_to_frame(arr, stfr, prefix='v', force=False):
 	if not has_num_pand['pknum']:
 		raise SystemError('NumPy package is required to use this function.')
 
+	numpy2stata.check_array_layout(arr, copy, missingmask)
+
 	stframe = None
 	try:
 		stframe = sfi.Frame.connect(stfr)
@@ -622,17 +1146,23 @@ def nparray_to_frame(arr, stfr, prefix='v', force=False):
 
 		stframe.drop()
 
-	numpy2stata.array_to_stata(arr, stfr, prefix)
+	numpy2stata.array_to_stata(arr, stfr, prefix, copy, missingmask)
 
 
+@stworker.locked
 def pdataframe_to_frame(df, stfr, force=False):
 	"""
 	Load a pandas DataFrame into a specified frame in Stata.
 
 	Each column of the DataFrame will be stored as a variable in the frame.
 	If the column type conforms to a Stata variable type, the variable type
-	will be used in the frame. Otherwise, the column will be converted into a
-	string variable in the frame.
+	will be used in the frame. A categorical column is stored as a numeric
+	variable holding the category codes, with a value label of the same name
+	built from the categories. A datetime column is stored as a Stata
+	datetime (**%tc**), or as a Stata date (**%td**) when every value falls
+	on midnight, and a timedelta column is stored as a number of
+	milliseconds. Otherwise, the column will be converted into a string
+	variable in the frame.
 
 	The variable names will correspond to the column names of the DataFrame.
 	If the column name is a valid Stata name, it will be used as the
@@ -685,7 +1215,165 @@ def pdataframe_to_frame(df, stfr, force=False):
 	pandas2stata.dataframe_to_stata(df, stfr)
 
 
-def nparray_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=False, missingval=_DefaultMissing()):
+@stworker.locked
+def pdataframe_chunks_to_frame(chunks, stfr, force=False):
+	"""
+	Load a sequence of pandas DataFrames into a specified frame in Stata.
+
+	The DataFrames are loaded one at a time, in the same way as
+	:meth:`~pystata.stata.pdataframe_chunks_to_data`, and the rows of all
+	the chunks are stored in the frame.
+
+	If the frame of the specified name already exists in Stata, an attempt to
+	load the DataFrames into the frame will raise an exception. The `force`
+	argument will force loading of the DataFrames, replacing the original
+	frame.
+
+	Parameters
+	----------
+	chunks : iterable of pandas DataFrames
+		The DataFrames to be loaded.
+
+	stfr : str
+		The frame in which to store the DataFrames.
+
+	force : bool, optional
+		Force loading of the DataFrames into the frame if the frame already
+		exists. Default is False.
+
+	Raises
+	------
+	SystemError
+		This error can be raised if the specified frame already exists
+		in Stata, and `force` is False.
+
+	ValueError
+		This error can be raised if a chunk does not have the same columns as
+		the first chunk.
+
+	TypeError
+		This error can be raised if a column holding numeric values in the
+		first chunk holds strings in a later chunk.
+	"""
+	global has_num_pand
+	config.check_initialized()
+
+	if not has_num_pand['pkpand']:
+		raise SystemError('pandas package is required to use this function.')
+
+	stframe = None
+	try:
+		stframe = sfi.Frame.connect(stfr)
+	except:
+		pass
+
+	if stframe is not None:
+		if force is False:
+			raise SystemError('%s already exists.' % stfr)
+
+		stframe.drop()
+
+	pandas2stata.dataframe_chunks_to_stata(chunks, stfr)
+
+
+def _prepare_frame_input(val):
+	if isinstance(val, np.ndarray):
+		return numpy2stata.store_array, numpy2stata.prepare_array(val, 'v')
+
+	if not has_num_pand['pkpand']:
+		raise TypeError("An NumPy array is required.")
+
+	return pandas2stata.store_dataframe, pandas2stata.prepare_dataframe(val)
+
+
+@stworker.locked
+def load_frames(frames, force=False, workers=None):
+	"""
+	Load several NumPy arrays or pandas DataFrames into Stata, each as a
+	separate frame.
+
+	The Python-side preparation of every input, which includes classifying
+	the column types, measuring the string widths, and converting the 
+	values, runs concurrently on a pool of threads without calling into 
+	Stata. Making the variable names, creating each frame, and storing its 
+	values are done one frame at a time on the calling thread.
+	Each input is stored the same way as with
+	:meth:`~pystata.stata.nparray_to_frame` or
+	:meth:`~pystata.stata.pdataframe_to_frame`.
+
+	If any of the frames already exist in Stata, an exception is raised
+	before any of the inputs are loaded. The `force` argument will force
+	loading of the inputs, replacing the original frames.
+
+	Parameters
+	----------
+	frames : dict
+		A dictionary that maps the name of each frame to the NumPy array or
+		pandas DataFrame to be stored in it.
+
+	force : bool, optional
+		Force loading of the inputs into the frames if any of the frames
+		already exist. Default is False.
+
+	workers : int, optional
+		The number of threads used to prepare the inputs. By default, one
+		thread is used for each input, up to the number of CPUs.
+
+	Returns
+	-------
+	Dictionary
+		A dictionary that maps the name of each frame to a dictionary with
+		the time, in seconds, spent on preparing (**prepare**) and on
+		storing (**store**) its input.
+
+	Raises
+	------
+	SystemError
+		This error can be raised if one of the frames already exists in
+		Stata, and `force` is False.
+	"""
+	global has_num_pand
+	config.check_initialized()
+
+	if not has_num_pand['pknum']:
+		raise SystemError('NumPy package is required to use this function.')
+
+	stframes = {}
+	for stfr in frames:
+		try:
+			stframes[stfr] = sfi.Frame.connect(stfr)
+		except:
+			pass
+
+	if len(stframes) > 0 and force is False:
+		raise SystemError('%s already exists.' % ', '.join(stframes))
+
+	def prepare(val):
+		start = time.time()
+		store, plan = _prepare_frame_input(val)
+		return store, plan, time.time() - start
+
+	if workers is None:
+		workers = max(1, min(len(frames), os.cpu_count() or 1))
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = dict((stfr, executor.submit(prepare, val)) for stfr, val in frames.items())
+
+		timing = {}
+		for stfr, future in futures.items():
+			store, plan, ptime = future.result()
+			start = time.time()
+			if stfr in stframes:
+				stframes[stfr].drop()
+
+			store(plan, stfr)
+			timing[stfr] = {'prepare': ptime, 'store': time.time() - start}
+
+	return timing
+
+
+@stworker.locked
+def nparray_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=False, missingval=_DefaultMissing(), chunksize=None, typed=False, missingmask=False):
 	"""
 	Export values from a Stata frame into a NumPy array.
 
@@ -721,6 +1409,37 @@ def nparray_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=Fals
 		list are replaced by this value. If it is not specified, the numeric
 		value of the corresponding missing value in Stata is returned.
 
+	chunksize : int, optional
+		If `chunksize` is specified, an iterator is returned instead, which
+		yields one NumPy array for each block of `chunksize` observations. The
+		blocks are read from Stata as the iterator advances, so only one
+		block is held in Python at a time.
+
+	typed : bool, optional
+		Return a structured array with one typed field per variable. Default
+		is False. The fields are named after the variables, and their types
+		follow the storage types of the variables: **byte**, **int**,
+		**long**, **float**, and **double** become int8, int16, int32,
+		float32, and float64. A field is float64 instead when the variable 
+		contains missing values and `missingval` does not fit the narrower 
+		type. The types are decided once for the whole variable, so every 
+		chunk of a chunked export has the same fields. The values are 
+		filled into preallocated memory one column at a time. Only
+		numeric variables can be exported this way, and `valuelabel` cannot
+		be used.
+
+	missingmask : bool, optional
+		Return the missing values as NaN together with a mask that records
+		which missing value each cell held. Default is False. When set to
+		True, a tuple of the array and a uint8 array of the same shape is
+		returned; for a typed export, the mask has one column per field. A
+		mask code of 0 marks a nonmissing value, 1 marks the system missing
+		value (.), and 2 to 27 mark the extended missing values .a to .z.
+		The conversion is done on whole columns at once. Only numeric
+		variables can be exported this way, and `missingval` cannot be
+		specified. The mask can be passed back to
+		:meth:`~pystata.stata.nparray_to_data` to restore the missing values.
+
 	Returns
 	-------
 	NumPy array
@@ -728,6 +1447,10 @@ def nparray_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=Fals
 
 	Raises
 	------
+	TypeError
+		This error can be raised if `typed` is True and any of the variables
+		specified in `var` are string variables.
+
 	ValueError
 		This error can be raised for three possible reasons. One is if any
 		of the variable indices or names specified in `var` are out of
@@ -748,12 +1471,34 @@ def nparray_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=Fals
 		raise SystemError('NumPy package is required to use this function.')
 
 	if isinstance(missingval, _DefaultMissing):
-		return numpy2stata.array_from_stata(stfr, var, obs, selectvar, valuelabel, None)
+		missingval = None
+	elif missingmask:
+		raise ValueError('missingval cannot be used with missingmask')
+
+	if typed:
+		if valuelabel:
+			raise ValueError('valuelabel cannot be used with a typed export')
+
+		if chunksize is not None:
+			arr = numpy2stata.array_from_stata_typed_chunks(stfr, var, obs, selectvar, missingval, chunksize)
+		else:
+			arr = numpy2stata.array_from_stata_typed(stfr, var, obs, selectvar, missingval)
+	elif chunksize is not None:
+		arr = numpy2stata.array_from_stata_chunks(stfr, var, obs, selectvar, valuelabel, missingval, chunksize)
 	else:
-		return numpy2stata.array_from_stata(stfr, var, obs, selectvar, valuelabel, missingval)
+		arr = numpy2stata.array_from_stata(stfr, var, obs, selectvar, valuelabel, missingval)
+
+	if missingmask and arr is not None:
+		if chunksize is not None:
+			return map(numpy2stata.array_split_missing, arr)
+		else:
+			return numpy2stata.array_split_missing(arr)
+
+	return arr
 
 
-def pdataframe_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=False, missingval=_DefaultMissing()):
+@stworker.locked
+def pdataframe_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=False, missingval=_DefaultMissing(), chunksize=None, missingmask=False):
 	"""
 	Export values from a Stata frame into a pandas DataFrame.
 
@@ -782,17 +1527,37 @@ def pdataframe_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=F
 		values for the variables specified in `var` are to be excluded.
 
 	valuelabel : bool, optional
-		Use the value label when available. Default is False.
+		Use the value label when available. Default is False. When set to
+		True, each variable with a value label is returned as a categorical
+		column. It is built from the numeric values and the value label,
+		without creating a string for each observation.
 
 	missingval : :ref:`_DefaultMissing <ref-defaultmissing>`, `optional`
 		If `missingval` is specified, all the missing values in the returned
 		list are replaced by this value. If it is not specified, the numeric
 		value of the corresponding missing value in Stata is returned.
 
+	chunksize : int, optional
+		If `chunksize` is specified, an iterator is returned instead, which
+		yields one pandas DataFrame for each block of `chunksize`
+		observations. The blocks are read from Stata as the iterator
+		advances, so only one block is held in Python at a time.
+
+	missingmask : bool, optional
+		Return the missing values as NaN together with a mask that records
+		which missing value each cell held. Default is False. When set to
+		True, a tuple of the DataFrame and a DataFrame of uint8 codes for its
+		numeric columns is returned. A code of 0 marks a nonmissing value, 1
+		marks the system missing value (.), and 2 to 27 mark the extended
+		missing values .a to .z. The conversion is done on whole columns at
+		once, and `missingval` cannot be specified.
+
 	Returns
 	-------
 	pandas DataFrame
 		A pandas DataFrame containing the values from the Stata frame.
+		Variables with a **%tc** or **%td** display format are returned as
+		datetime columns.
 
 	Raises
 	------
@@ -816,78 +1581,177 @@ def pdataframe_from_frame(stfr, var=None, obs=None, selectvar=None, valuelabel=F
 		raise SystemError('pandas package is required to use this function.')
 
 	if isinstance(missingval, _DefaultMissing):
-		return pandas2stata.dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, None)
-	else:
-		return pandas2stata.dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, missingval)
-
-
-def _get_return_val(res, cat):
-	if cat=="r()":
-		rrscalar = sfi.SFIToolkit.listReturn("r()", "scalar")
-		rscalar = rrscalar.split()
-		for rs in rscalar:
-			rs = "r(" + rs + ")"
-			val = sfi.Scalar.getValue(rs)
-			res[rs] = val
-
-		rrmac = sfi.SFIToolkit.listReturn("r()", "macro")
-		rmac = rrmac.split()
-		for rs in rmac:
-			rs = "r(" + rs + ")"
-			val = sfi.Macro.getGlobal(rs)
-			res[rs] = val
-
-		rrmat = sfi.SFIToolkit.listReturn("r()", "matrix")
-		rmat = rrmat.split()
-		for rm in rmat:
-			rm = "r(" + rm + ")"
-			val = numpy2stata.array_from_matrix(sfi.Matrix.get(rm))
-			res[rm] = val
-
-	elif cat=="e()":
-		eenum = sfi.SFIToolkit.listReturn("e()", "scalar")
-		enum = eenum.split()
-		for en in enum:
-			en = "e(" + en + ")"
-			val = sfi.Scalar.getValue(en)
-			res[en] = val
-
-		eestr = sfi.SFIToolkit.listReturn("e()", "macro")
-		estr = eestr.split()
-		for es in estr:
-			es = "e(" + es + ")"
-			val = sfi.Macro.getGlobal(es)
-			res[es] = val
-
-		eemat = sfi.SFIToolkit.listReturn("e()", "matrix")
-		emat = eemat.split()
-		for em in emat:
-			em = "e(" + em + ")"
-			val = numpy2stata.array_from_matrix(sfi.Matrix.get(em))
-			res[em] = val
+		missingval = None
+	elif missingmask:
+		raise ValueError('missingval cannot be used with missingmask')
 
+	if chunksize is not None:
+		df = pandas2stata.dataframe_from_stata_chunks(stfr, var, obs, selectvar, valuelabel, missingval, chunksize)
 	else:
-		ssmac = sfi.SFIToolkit.listReturn("s()", "macro")
-		smac = ssmac.split()
-		for ss in smac:
-			ss = "s(" + ss + ")"
-			val = sfi.Macro.getGlobal(ss)
-			res[ss] = val
+		df = pandas2stata.dataframe_from_stata(stfr, var, obs, selectvar, valuelabel, missingval)
+
+	if missingmask and df is not None:
+		if chunksize is not None:
+			return map(pandas2stata.dataframe_split_missing, df)
+		else:
+			return pandas2stata.dataframe_split_missing(df)
+
+	return df
+
+
+_return_types = {
+	"r()": ["scalar", "macro", "matrix"],
+	"e()": ["scalar", "macro", "matrix"],
+	"s()": ["macro"]
+}
+
+class _ReturnSnapshot:
+	"""
+	The stored results of one category as listed by a single call to a 
+	return accessor, with the values retrieved from them so far.
+	"""
+	def __init__(self, cat):
+		self.cat = cat
+		self.serial = config.stserial
+		self.kinds = {}
+		self.values = {}
+		for kind in _return_types[cat]:
+			for name in sfi.SFIToolkit.listReturn(cat, kind).split():
+				self.kinds[cat[0] + "(" + name + ")"] = kind
+
+	def get(self, key, labels=False):
+		if key not in self.values:
+			kind = self.kinds[key]
+			if kind == "scalar":
+				val = sfi.Scalar.getValue(key)
+			elif kind == "macro":
+				val = sfi.Macro.getGlobal(key)
+			else:
+				val = numpy2stata.array_from_stata_matrix(key)
+			self.values[key] = val
+
+		val = self.values[key]
+		if labels and self.kinds[key] == "matrix":
+			val = pandas2stata.dataframe_from_matrix(key, val)
+
+		return val
+
+
+def _select_return_keys(snapshot, keys, pattern):
+	names = list(snapshot.kinds)
+	if keys is None and pattern is None:
+		return names
+
+	selected = []
+	if keys is not None:
+		if isinstance(keys, str):
+			keys = [keys]
+		for key in keys:
+			if not key.startswith(snapshot.cat[0] + "("):
+				key = snapshot.cat[0] + "(" + key + ")"
+			if key not in snapshot.kinds:
+				raise KeyError(key + " not found")
+			if key not in selected:
+				selected.append(key)
+
+	if pattern is not None:
+		if not pattern.startswith(snapshot.cat[0] + "("):
+			pattern = snapshot.cat[0] + "(" + pattern + ")"
+		for key in fnmatch.filter(names, pattern):
+			if key not in selected:
+				selected.append(key)
+
+	return selected
+
+
+class ReturnResults(Mapping):
+	"""
+	A read-only mapping of stored results whose values are retrieved from 
+	Stata the first time they are accessed. It is returned by 
+	:meth:`get_return`, :meth:`get_ereturn`, and :meth:`get_sreturn` when 
+	`lazy` is True. Values that have not been retrieved yet are no longer 
+	available after another command has been run through pystata, and 
+	accessing them raises a SystemError. Commands issued directly through 
+	the sfi module are not tracked.
+	"""
+	def __init__(self, snapshot, names, labels=False):
+		self._snapshot = snapshot
+		self._names = names
+		self._labels = labels
+
+	def __getitem__(self, key):
+		if key not in self._names:
+			raise KeyError(key)
+
+		with stworker.lock:
+			if self._snapshot.serial != config.stserial:
+				if key not in self._snapshot.values or (self._labels and self._snapshot.kinds[key] == "matrix"):
+					raise SystemError(key + ' is no longer available; another command has been run since.')
+
+			return self._snapshot.get(key, self._labels)
+
+	def __iter__(self):
+		return iter(self._names)
+
+	def __len__(self):
+		return len(self._names)
+
+	def __contains__(self, key):
+		return key in self._names
+
+	def __repr__(self):
+		return 'ReturnResults(%s)' % ', '.join(self._names)
+
+
+def _get_return_val(cat, keys=None, pattern=None, lazy=False, labels=False):
+	global has_num_pand
+	if labels and not has_num_pand['pkpand']:
+		raise SystemError('pandas package is required to use this function.')
+
+	snapshot = _ReturnSnapshot(cat)
+	names = _select_return_keys(snapshot, keys, pattern)
+	if lazy:
+		return ReturnResults(snapshot, names, labels)
+
+	res = {}
+	for key in names:
+		res[key] = snapshot.get(key, labels)
 
 	return res
 
-	
-def get_return():
+
+@stworker.locked
+def get_return(keys=None, pattern=None, lazy=False, labels=False):
 	"""
 	Retrieve current **r()** results and store them in a Python dictionary.
 
 	The keys are Stata's macro and scalar names, and the values are their
 	corresponding values. Stata's matrices are converted into NumPy arrays.
 
+	Parameters
+	----------
+	keys : str or list of str, optional
+		Retrieve only the specified results, such as **r(N)** or **N**. 
+		A KeyError is raised if a result does not exist.
+
+	pattern : str, optional
+		Retrieve only the results whose names match this wildcard pattern, 
+		such as **r(b*)** or **b***. It can be combined with `keys`.
+
+	lazy : bool, optional
+		Return a :class:`ReturnResults` mapping that retrieves each value 
+		only when it is accessed. Default is False.
+
+	labels : bool, optional
+		Return matrices as pandas DataFrames whose index and columns are 
+		the row and column names of the matrices, prefixed with their 
+		equation names, if any. Default is False.
+
 	Returns
 	-------
-	Dictionary
-		A dictionary containing current **r()** results.
+	Dictionary or ReturnResults
+		A dictionary containing current **r()** results, or a 
+		ReturnResults mapping if `lazy` is True.
 	"""
 	global has_num_pand
 	config.check_initialized()
@@ -895,22 +1759,41 @@ def get_return():
 	if not has_num_pand['pknum']:
 		raise SystemError('NumPy package is required to use this function.')
 
-	res = {}
-	_get_return_val(res, "r()")
-	return res
+	return _get_return_val("r()", keys, pattern, lazy, labels)
 
 
-def get_ereturn():
+@stworker.locked
+def get_ereturn(keys=None, pattern=None, lazy=False, labels=False):
 	"""
 	Retrieve current **e()** results and store them in a Python dictionary.
 
 	The keys are Stata's macro and scalar names, and the values are their
 	corresponding values. Stata's matrices are converted into NumPy arrays.
 
+	Parameters
+	----------
+	keys : str or list of str, optional
+		Retrieve only the specified results, such as **e(N)** or **N**. 
+		A KeyError is raised if a result does not exist.
+
+	pattern : str, optional
+		Retrieve only the results whose names match this wildcard pattern, 
+		such as **e(b*)** or **b***. It can be combined with `keys`.
+
+	lazy : bool, optional
+		Return a :class:`ReturnResults` mapping that retrieves each value 
+		only when it is accessed. Default is False.
+
+	labels : bool, optional
+		Return matrices as pandas DataFrames whose index and columns are 
+		the row and column names of the matrices, prefixed with their 
+		equation names, if any. Default is False.
+
 	Returns
 	-------
-	Dictionary
-		A dictionary containing current **e()** results.
+	Dictionary or ReturnResults
+		A dictionary containing current **e()** results, or a 
+		ReturnResults mapping if `lazy` is True.
 	"""
 	global has_num_pand
 	config.check_initialized()
@@ -918,22 +1801,36 @@ def get_ereturn():
 	if not has_num_pand['pknum']:
 		raise SystemError('NumPy package is required to use this function.')
 
-	res = {}
-	_get_return_val(res, "e()")
-	return res
+	return _get_return_val("e()", keys, pattern, lazy, labels)
 
 
-def get_sreturn():
+@stworker.locked
+def get_sreturn(keys=None, pattern=None, lazy=False):
 	"""
 	Retrieve current **s()** results and store them in a Python dictionary.
 
 	The keys are Stata's macro and scalar names, and the values are their
 	corresponding values. Stata's matrices are converted into NumPy arrays.
 
+	Parameters
+	----------
+	keys : str or list of str, optional
+		Retrieve only the specified results, such as **s(N)** or **N**. 
+		A KeyError is raised if a result does not exist.
+
+	pattern : str, optional
+		Retrieve only the results whose names match this wildcard pattern, 
+		such as **s(b*)** or **b***. It can be combined with `keys`.
+
+	lazy : bool, optional
+		Return a :class:`ReturnResults` mapping that retrieves each value 
+		only when it is accessed. Default is False.
+
 	Returns
 	-------
-	Dictionary
-		A dictionary containing current **s()** results.
+	Dictionary or ReturnResults
+		A dictionary containing current **s()** results, or a 
+		ReturnResults mapping if `lazy` is True.
 	"""
 	global has_num_pand
 	config.check_initialized()
@@ -941,6 +1838,4 @@ def get_sreturn():
 	if not has_num_pand['pknum']:
 		raise SystemError('NumPy package is required to use this function.')
 	
-	res = {}
-	_get_return_val(res, "s()")
-	return res
+	return _get_return_val("s()", keys, pattern, lazy)